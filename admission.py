@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from collections import OrderedDict
+import math
+import threading
+import time
+
+import metrics
+from tokens import Token, SoundEffect, SoundFilter, Group
+
+
+class Rejected(Exception):
+    """
+    Raised by AdmissionController.admit. status is 413 (the request can
+    never fit), 429 (the client is over its share) or 503 (the server is
+    over its budget), retry_after is in seconds.
+    """
+
+    status: int
+    retry_after: int
+
+    def __init__(self, message, status, retry_after=1) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Ticket():
+    client: str
+    cost: float
+    started: float
+
+    def __init__(self, client, cost) -> None:
+        self.client = client
+        self.cost = cost
+        self.started = time.monotonic()
+
+
+def count_tokens(token: Token) -> tuple[int, int]:
+    # (filters, sound effects) in the tree
+    if isinstance(token, SoundFilter):
+        filters, effects = count_tokens(token.group)
+        return filters + 1, effects
+    if isinstance(token, SoundEffect):
+        return 0, 1
+    if isinstance(token, Group):
+        filters, effects = 0, 0
+        for child in token.tokens:
+            f, e = count_tokens(child)
+            filters, effects = filters + f, effects + e
+        return filters, effects
+    return 0, 0
+
+
+class AdmissionController():
+    """
+    Bounds the work queued on the synthesis pool. Every request gets a cost
+    in estimated seconds of synthesis, from its tokenized tree. Requests are
+    admitted while the number and total cost of unfinished requests stay
+    within max_queue and max_cost, and while the client stays within
+    client_share of both, so one client cannot starve the others.
+    """
+
+    # estimated seconds per character of speech, per model load, per
+    # filter and per sound effect
+    char_cost = 0.02
+    load_cost = 3.0
+    filter_cost = 0.1
+    effect_cost = 0.01
+
+    max_queue: int
+    max_cost: float
+    client_share: float
+    workers: int
+
+    def __init__(self, max_queue=8, max_cost=120.0, client_share=0.5,
+                 workers=1, warm_speakers=4) -> None:
+        self.max_queue = max_queue
+        self.max_cost = max_cost
+        self.client_share = client_share
+        self.workers = workers
+        self.lock = threading.Lock()
+
+        self.queued = 0
+        self.queued_cost = 0.0
+        # (requests, cost) in flight per client
+        self.clients: dict[str, tuple[int, float]] = {}
+
+        # speakers used by recent requests, which are probably still loaded
+        self.warm: OrderedDict[str, None] = OrderedDict()
+        self.warm_speakers = warm_speakers
+
+        # actual seconds per estimated second, corrects retry_after
+        self.speed = 1.0
+
+    def estimate(self, root: Token) -> float:
+        characters = 0
+        speakers = set()
+        for speech in root.speeches():
+            characters += len(speech.text)
+            speakers.add(speech.speaker)
+        with self.lock:
+            loads = len([s for s in speakers if s not in self.warm])
+        filters, effects = count_tokens(root)
+        return (characters * self.char_cost + loads * self.load_cost
+                + filters * self.filter_cost + effects * self.effect_cost)
+
+    def retry_after(self, cost: float) -> int:
+        # time until the pool has worked through cost seconds of queue
+        return max(1, math.ceil(cost * self.speed / self.workers))
+
+    def admit(self, client: str, root: Token) -> Ticket:
+        # raises Rejected if the request does not fit right now
+        cost = self.estimate(root)
+        speakers = [speech.speaker for speech in root.speeches()]
+        with self.lock:
+            if cost > self.max_cost:
+                metrics.ADMISSION_REJECTIONS.inc(status=413)
+                raise Rejected("Request is too long", 413)
+
+            requests, client_cost = self.clients.get(client, (0, 0.0))
+            max_client_requests = max(1, int(self.max_queue * self.client_share))
+            max_client_cost = max(cost, self.max_cost * self.client_share)
+            if (requests + 1 > max_client_requests
+                    or client_cost + cost > max_client_cost):
+                metrics.ADMISSION_REJECTIONS.inc(status=429)
+                raise Rejected("Too many requests from this client", 429,
+                               self.retry_after(client_cost))
+
+            if (self.queued + 1 > self.max_queue
+                    or self.queued_cost + cost > self.max_cost):
+                excess = self.queued_cost + cost - self.max_cost
+                metrics.ADMISSION_REJECTIONS.inc(status=503)
+                raise Rejected("Server is busy", 503,
+                               self.retry_after(max(excess, cost)))
+
+            self.queued += 1
+            self.queued_cost += cost
+            self.clients[client] = (requests + 1, client_cost + cost)
+            for speaker in speakers:
+                self.warm[speaker] = None
+                self.warm.move_to_end(speaker)
+            while len(self.warm) > self.warm_speakers:
+                self.warm.popitem(last=False)
+        return Ticket(client, cost)
+
+    def release(self, ticket: Ticket):
+        elapsed = time.monotonic() - ticket.started
+        with self.lock:
+            self.queued -= 1
+            self.queued_cost -= ticket.cost
+            requests, client_cost = self.clients[ticket.client]
+            if requests == 1:
+                del self.clients[ticket.client]
+            else:
+                self.clients[ticket.client] = (requests - 1,
+                                               client_cost - ticket.cost)
+            if ticket.cost > 0:
+                # moving average, includes time spent waiting in the queue
+                self.speed = 0.9 * self.speed + 0.1 * (elapsed / ticket.cost)
@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from concurrent.futures import as_completed
+import io
+import json
+import os
+import re
+import time
+import soundfile as sf
+
+from synthesis_pool import SynthesisPool
+
+
+def safe_name(name: str) -> str:
+    # item ids become file names, keep them inside outdir
+    return re.sub(r"[^\w.-]", "_", name).lstrip(".") or "_"
+
+
+def read_items(path: str) -> list[tuple[str, str]]:
+    """
+    Returns (id, script) pairs from either a directory of .txt scripts (the
+    id is the file name) or a JSONL manifest with a "text" and optionally an
+    "id" per line (by default the line number).
+    """
+    items = []
+    if os.path.isdir(path):
+        for file in sorted(os.listdir(path)):
+            if file.endswith(".txt"):
+                with open(os.path.join(path, file)) as f:
+                    items.append((file[:-4], f.read().replace("\n", " ")))
+    else:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                if len(line.strip()) == 0:
+                    continue
+                entry = json.loads(line)
+                if "text" not in entry:
+                    raise ValueError("%s:%d has no \"text\"" % (path, number))
+                items.append((str(entry.get("id", "%06d" % number)),
+                              entry["text"]))
+
+    ids = set()
+    for id, _ in items:
+        if safe_name(id) in ids:
+            raise ValueError("Duplicate item \"%s\" in %s" % (id, path))
+        ids.add(safe_name(id))
+    return items
+
+
+def write_atomic(path: str, data: bytes):
+    # a killed run never leaves a partial file that looks done
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def render_batch(path: str, outdir: str, pool: SynthesisPool, format="wav"):
+    """
+    Renders every item of path into outdir/<id>.<format> on pool. Items
+    whose output already exists are skipped, so an interrupted run can be
+    resumed by running it again.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    items = read_items(path)
+
+    futures = {}
+    skipped = 0
+    start = time.perf_counter()
+    for id, text in items:
+        outfile = os.path.join(outdir, "%s.%s" % (safe_name(id), format))
+        if os.path.exists(outfile):
+            skipped += 1
+            continue
+        futures[pool.submit(text, format)] = (id, outfile)
+    print("INFO: rendering %d items, %d already done" % (len(futures), skipped))
+
+    done, empty, failed = 0, 0, 0
+    audio_seconds = 0.0
+    for future in as_completed(futures):
+        id, outfile = futures[future]
+        try:
+            audio = future.result()
+        except Exception as e:
+            failed += 1
+            print("ERROR: %s failed: %s" % (id, e))
+            continue
+        if audio is None:
+            empty += 1
+            print("WARNING: %s synthesized nothing" % id)
+            continue
+        try:
+            duration = sf.info(io.BytesIO(audio)).duration
+            write_atomic(outfile, audio)
+        except Exception as e:
+            failed += 1
+            print("ERROR: %s could not be written: %s" % (id, e))
+            continue
+        audio_seconds += duration
+        done += 1
+        print("[%d/%d] %s" % (done + empty + failed, len(futures), outfile))
+
+    elapsed = time.perf_counter() - start
+    print("-" * 50)
+    print("Rendered %d items (%d skipped, %d empty, %d failed) in %.1fs"
+          % (done, skipped, empty, failed, elapsed))
+    if elapsed > 0:
+        print("%.2f items/s, %.1fs of audio, %.2fx real time"
+              % (done / elapsed, audio_seconds, audio_seconds / elapsed))
+    return failed == 0
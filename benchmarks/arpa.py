@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Compares PronunciationDictionary.arpa against the original string
+# concatenating implementation of BitcoinMiner.arpa.
+#
+#   ./benchmarks/arpa.py [--words 1000,10000,100000] [--dictionary FILE]
+
+import os
+import random
+import sys
+import tempfile
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pronunciation import PronunciationDictionary, parse_dictionary  # noqa: E402
+
+
+def legacy_arpa(thisdict, text, punctuation=r"!?,.;", EOS_Token=True):
+    out = ""
+    for word_ in text.split(" "):
+        word = word_
+        end_chars = ""
+        while any(elem in word for elem in punctuation) and len(word) > 1:
+            if word[-1] in punctuation: end_chars = word[-1] + end_chars; word = word[:-1]
+            else: break
+        try:
+            word_arpa = thisdict[word.upper()]
+            word = "{" + str(word_arpa) + "}"
+        except KeyError:
+            pass
+        out = (out + " " + word + end_chars).strip()
+    if EOS_Token and out[-1] != ";":
+        out += ";"
+    return out
+
+
+def synthetic_dictionary(path, words):
+    rng = random.Random(0)
+    phonemes = ["AA1", "AE0", "B", "K", "D", "EH1", "F", "G", "IY0", "L",
+                "M", "N", "OW1", "P", "R", "S", "T", "UW1", "V", "Z"]
+    with open(path, "w") as f:
+        for i in range(words):
+            f.write("WORD%d  %s\n" % (i, " ".join(rng.choices(phonemes, k=5))))
+
+
+def synthetic_text(vocabulary, words):
+    rng = random.Random(1)
+    punctuation = ["", "", "", ",", ".", "!", "?", "...", ";"]
+    return " ".join(rng.choice(vocabulary).lower() + rng.choice(punctuation)
+                    for _ in range(words))
+
+
+def timed(function, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+@click.command()
+@click.option("--words", default="1000,10000,100000",
+              help="Comma separated input sizes in words")
+@click.option("--dictionary", default=None,
+              help="CMUdict file to use instead of a synthetic one")
+def main(words, dictionary):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "cmudict.txt")
+        if dictionary is None:
+            synthetic_dictionary(source, 130000)
+        else:
+            with open(dictionary, "rb") as src, open(source, "wb") as dst:
+                dst.write(src.read())
+
+        thisdict = parse_dictionary(source)
+        vocabulary = list(thisdict.keys())[:5000] + ["UNKNOWN", "HELLO"]
+
+        pronunciations = PronunciationDictionary(tmp, os.path.join(tmp, "index"))
+        compile_time, _ = timed(lambda: pronunciations.open("cmudict"), 1)
+        pronunciations.indexes.clear()
+        open_time, _ = timed(lambda: PronunciationDictionary(
+            tmp, os.path.join(tmp, "index")).open("cmudict"))
+        parse_time, _ = timed(lambda: parse_dictionary(source))
+        print("entries: %d" % len(thisdict))
+        print("compile index: %.1f ms" % (compile_time * 1000))
+        print("open index:    %.3f ms" % (open_time * 1000))
+        print("parse text:    %.1f ms" % (parse_time * 1000))
+        print()
+
+        print("%10s %12s %12s %8s" % ("words", "legacy (ms)", "index (ms)", "same"))
+        for n in [int(x) for x in words.split(",")]:
+            text = synthetic_text(vocabulary, n)
+            legacy_time, expected = timed(lambda: legacy_arpa(thisdict, text))
+            new_time, actual = timed(lambda: pronunciations.arpa(text))
+            print("%10d %12.1f %12.1f %8s" % (n, legacy_time * 1000,
+                                              new_time * 1000,
+                                              expected == actual))
+
+
+if __name__ == "__main__":
+    main()
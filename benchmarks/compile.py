@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Compares the compile modes of BitcoinMiner on CPU: time to load and
+# compile, Tacotron2 decoder latency per step (prenet and decode) at each
+# batch size, HiFi-GAN throughput (seconds of audio per second) and the
+# end to end real-time factor (lower is better).
+#
+#   ./benchmarks/compile.py [--speaker udisen] [--threads 4] [--batch-sizes 1,4]
+
+import os
+import sys
+import time
+import click
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+SAMPLE_RATE = 22050
+
+
+def encode(bitcoin_miner, sentences):
+    # memory and mask of a batch of sentences, like infer_mels
+    import torch
+    model = bitcoin_miner.model
+    sequences = [torch.LongTensor(bitcoin_miner.text_to_sequence(s, None))
+                 for s in sentences]
+    sequences.sort(key=len, reverse=True)
+    lengths = torch.LongTensor([len(s) for s in sequences])
+    padded = torch.zeros(len(sequences), int(lengths[0]), dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        padded[row, :len(sequence)] = sequence
+    memory = model.encoder(model.embedding(padded).transpose(1, 2), lengths)
+    mask = torch.arange(memory.size(1))[None, :] >= lengths[:, None]
+    return memory, mask
+
+
+def decoder_step_ms(bitcoin_miner, sentences, steps) -> float:
+    import torch
+    decoder = bitcoin_miner.model.decoder
+    with torch.no_grad():
+        memory, mask = encode(bitcoin_miner, sentences)
+        decoder_input = decoder.get_go_frame(memory)
+        decoder.initialize_decoder_states(memory, mask=mask)
+        for _ in range(5):  # warm up
+            decoder_input, _, _ = decoder.decode(decoder.prenet(decoder_input))
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            decoder_input, _, _ = decoder.decode(decoder.prenet(decoder_input))
+        return (time.perf_counter() - start) / steps * 1000
+
+
+@click.command()
+@click.option("--speaker", default="udisen")
+@click.option("--threads", default=4, help="torch CPU threads")
+@click.option("--text", default="example-texts/poem.txt",
+              help="Text file, one utterance per non-empty line")
+@click.option("--lines", default=8, help="Number of lines to synthesize")
+@click.option("--modes", default="eager,torchscript,inductor",
+              help="Comma separated compile modes")
+@click.option("--batch-sizes", default="1,4",
+              help="Comma separated decoder batch sizes")
+@click.option("--steps", default=200, help="Decoder steps to time")
+def main(speaker, threads, text, lines, modes, batch_sizes, steps):
+    import torch
+    from bitcoin_miner import BitcoinMiner
+    from compiled import is_compiled
+
+    with open(text) as f:
+        sentences = [line.strip() for line in f if line.strip()][:lines]
+    batch_sizes = [int(b) for b in batch_sizes.split(",")]
+
+    print("%12s %9s %s %12s %8s %s" % (
+        "mode", "setup (s)",
+        " ".join("%11s" % ("step ms b%d" % b) for b in batch_sizes),
+        "vocoder xRT", "RTF", "compiled"))
+    for mode in modes.split(","):
+        start = time.perf_counter()
+        bitcoin_miner = BitcoinMiner(False, threads, use_synthesis_cache=False,
+                                     prefetch=False, compile_mode=mode)
+        bitcoin_miner.update_model(speaker)
+        setup = time.perf_counter() - start
+
+        step_ms = [decoder_step_ms(bitcoin_miner,
+                                   (sentences * b)[:b], steps)
+                   for b in batch_sizes]
+
+        # the decoder prenet always applies dropout, use the same noise
+        torch.manual_seed(0)
+        with torch.no_grad():
+            mels = [bitcoin_miner.infer_mel(
+                bitcoin_miner.text_to_sequence(s, None)) for s in sentences]
+            bitcoin_miner.run_hifigan(mels[0])  # warm up
+            start = time.perf_counter()
+            duration = sum(bitcoin_miner.run_hifigan(mel).size(-1)
+                           for mel in mels) / SAMPLE_RATE
+            vocoder = duration / (time.perf_counter() - start)
+
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        duration = sum(len(bitcoin_miner.end_to_end_infer(s, None))
+                       for s in sentences) / SAMPLE_RATE
+        rtf = (time.perf_counter() - start) / duration
+
+        # modes that failed to compile fall back to eager, say which did
+        model = bitcoin_miner.model
+        compiled = [name for name, done in (
+            ("prenet", is_compiled(model.decoder.prenet)),
+            ("decode", is_compiled(model.decoder, "decode")),
+            ("postnet", is_compiled(model.postnet)),
+            ("hifigan", is_compiled(bitcoin_miner.hifigan))) if done]
+
+        print("%12s %9.1f %s %12.1f %8.3f %s" % (
+            mode, setup, " ".join("%11.2f" % ms for ms in step_ms), vocoder,
+            rtf, ",".join(compiled) or "-"))
+        del bitcoin_miner
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Runs the whole synthesis pipeline over a corpus of scripts and reports
+# latency percentiles and the real-time factor (stage time / audio
+# duration) of every stage, for each combination of CPU thread count and
+# batch size. Results are written as JSON and can be compared to a
+# previous run.
+#
+#   ./benchmarks/pipeline.py --tiny --threads 1,4 --batch-sizes 1,8
+#   ./benchmarks/pipeline.py --output new.json --compare old.json
+
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import defaultdict
+import click
+import numpy as np
+import soundfile as sf
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import dsp  # noqa: E402
+import tokens  # noqa: E402
+from tokens import Group, SAMPLE_RATE  # noqa: E402
+from tokenizer import Tokenizer  # noqa: E402
+
+
+FILTER_HEAVY_SCRIPTS = [
+    "udisen: hello {1} today will show {4} how can stream snipe {.} with "
+    "text to speech {.} [1] peroni: are you happy? {9} to steal my voice? "
+    "{.} fakin tresh.",
+    "{2} {6} udisen: this is a telephone call from the hall {.} {.} {10} "
+    "with a chorus {11} slowly {.} and {12} quickly {.} {.} [2]",
+    "{3} velcuz: remember to subscribe {5} to my only fans {.} {7} fifty "
+    "percent off {.} {8} limited time offer. {.}",
+]
+
+
+def load_corpus() -> list[str]:
+    with open(os.path.join("example-texts", "poem.txt")) as f:
+        poem = f.read().replace("\n", " ")
+    return [poem] + FILTER_HEAVY_SCRIPTS
+
+
+def tiny_miner_class():
+    """
+    BitcoinMiner with small randomly initialized models, so the pipeline
+    can be benchmarked without downloading any checkpoints. Audio is noise,
+    but every stage does the same kind of work as with real models.
+    """
+    import bitcoin_miner
+    from bitcoin_miner import BitcoinMiner
+
+    # the model classes only exist once the submodules are imported
+    bitcoin_miner.import_models()
+    AttrDict = bitcoin_miner.AttrDict
+    Generator = bitcoin_miner.Generator
+    Tacotron2 = bitcoin_miner.Tacotron2
+
+    class TinyMiner(BitcoinMiner):
+        def get_hifigan(self, use_exported=True):
+            with open(os.path.join("hifigan", "config_v1.json")) as f:
+                config = json.loads(f.read())
+            config["upsample_initial_channel"] = 32
+            h = AttrDict(config)
+            hifigan = Generator(h).to(self.device).eval()
+            hifigan.remove_weight_norm()
+            return hifigan, h
+
+        def get_tacotron2(self, model_path, use_exported=True):
+            hparams = self.tacotron2_hparams()
+            hparams["symbols_embedding_dim"] = 64
+            hparams["encoder_embedding_dim"] = 64
+            hparams["attention_rnn_dim"] = 128
+            hparams["decoder_rnn_dim"] = 128
+            hparams["prenet_dim"] = 64
+            hparams["attention_dim"] = 32
+            hparams["postnet_embedding_dim"] = 64
+            # the gate of an untrained model never fires
+            hparams["max_decoder_steps"] = 150
+            model = Tacotron2(hparams).to(self.device).eval()
+            return self.reduce_tacotron2_precision(model), hparams
+
+        def model_identity(self, model_path) -> str:
+            return "tiny:" + model_path
+
+    return TinyMiner
+
+
+class Timings():
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = defaultdict(list)
+
+    def add(self, stage: str, seconds: float):
+        self.samples[stage].append(seconds)
+
+    def time(self, stage: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.add(stage, time.perf_counter() - start)
+        return result
+
+    def summary(self, audio_seconds: float) -> dict:
+        stages = {}
+        for stage, samples in self.samples.items():
+            values = np.array(samples) * 1000
+            stages[stage] = {
+                "count": len(values),
+                "total_ms": float(values.sum()),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p90_ms": float(np.percentile(values, 90)),
+                "p99_ms": float(np.percentile(values, 99)),
+                "rtf": float(values.sum() / 1000 / audio_seconds)
+                if audio_seconds else None,
+            }
+        return stages
+
+
+def instrument(timings: Timings):
+    # time the filter and effect work done inside Token.render
+    apply_filter = dsp.apply_filter
+    get_effect = tokens.effect_bank.get
+
+    def timed_filter(*args):
+        return timings.time("filters", apply_filter, *args)
+
+    def timed_effect(*args):
+        return timings.time("effects", get_effect, *args)
+
+    tokens.dsp.apply_filter = timed_filter
+    tokens.effect_bank.get = timed_effect
+
+    def restore():
+        tokens.dsp.apply_filter = apply_filter
+        tokens.effect_bank.get = get_effect
+    return restore
+
+
+def run_script(miner, script: str, batch_size: int, timings: Timings) -> float:
+    import torch
+
+    root = Group([])
+    timings.time("tokenize", Tokenizer(script, root).tokenize, root)
+
+    speeches = list(root.speeches())
+    for speech in speeches:
+        timings.time("arpa", miner.arpa, speech.text)
+
+    if batch_size > 1:
+        by_speaker = defaultdict(list)
+        for speech in speeches:
+            by_speaker[speech.speaker].append(speech)
+        for speaker, group in by_speaker.items():
+            miner.update_model(speaker)
+            audios = timings.time("inference_batched", miner.batch_infer,
+                                  [s.text for s in group], None, batch_size)
+            for speech, audio in zip(group, audios):
+                speech.audio = audio
+    else:
+        for speech in speeches:
+            miner.update_model(speech.speaker)
+            parts = []
+            for sentence in miner.split_sentences(speech.text):
+                sequence = timings.time("text_to_sequence",
+                                        miner.text_to_sequence, sentence, None)
+                with torch.no_grad():
+                    mel = timings.time("tacotron2", miner.infer_mel, sequence)
+                    parts.append(timings.time("hifigan", miner.vocode, mel))
+            speech.audio = torch.cat(parts)
+
+    before = len(timings.samples["filters"]), len(timings.samples["effects"])
+    restore = instrument(timings)
+    try:
+        start = time.perf_counter()
+        samples = root.render()
+        render_time = time.perf_counter() - start
+    finally:
+        restore()
+    # whatever render did apart from filters and effects is concatenation
+    # and copying of the already synthesized speech
+    other = (sum(timings.samples["filters"][before[0]:])
+             + sum(timings.samples["effects"][before[1]:]))
+    timings.add("concatenate", max(render_time - other, 0))
+
+    if samples is None:
+        return 0.0
+    out = io.BytesIO()
+    timings.time("write", sf.write, out, samples, SAMPLE_RATE, format="WAV")
+    return len(samples) / SAMPLE_RATE
+
+
+def compare(old: dict, new: dict):
+    def key(run):
+        return (run["threads"], run["batch_size"])
+    previous = {key(run): run for run in old["runs"]}
+
+    print()
+    print("%8s %6s %-18s %12s %12s %8s" % ("threads", "batch", "stage",
+                                            "old p50 ms", "new p50 ms", "ratio"))
+    for run in new["runs"]:
+        if key(run) not in previous:
+            continue
+        for stage, stats in run["stages"].items():
+            before = previous[key(run)]["stages"].get(stage)
+            if before is None:
+                continue
+            ratio = stats["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float("nan")
+            print("%8d %6d %-18s %12.2f %12.2f %8.2f" % (
+                run["threads"], run["batch_size"], stage, before["p50_ms"],
+                stats["p50_ms"], ratio))
+
+
+@click.command()
+@click.option("--tiny", is_flag=True, default=False,
+              help="Use small randomly initialized models")
+@click.option("--threads", default="1,4", help="Comma separated CPU thread counts")
+@click.option("--batch-sizes", default="1,8", help="Comma separated batch sizes")
+@click.option("--repeat", default=3, help="Passes over the corpus per configuration")
+@click.option("--precision", default="fp32")
+@click.option("--output",
+              default=os.path.join(tempfile.gettempdir(), "pipeline.json"),
+              help="JSON results file")
+@click.option("--compare", "previous", default=None,
+              help="Results of a previous run to compare against")
+def main(tiny, threads, batch_sizes, repeat, precision, output, previous):
+    import torch
+    from bitcoin_miner import BitcoinMiner
+
+    miner_class = tiny_miner_class() if tiny else BitcoinMiner
+    miner = miner_class(False, 1, use_synthesis_cache=False, precision=precision)
+    corpus = load_corpus()
+
+    results = {
+        "config": {
+            "tiny": tiny,
+            "precision": precision,
+            "repeat": repeat,
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "runs": [],
+    }
+
+    for thread_count in [int(x) for x in threads.split(",")]:
+        torch.set_num_threads(thread_count)
+        for batch_size in [int(x) for x in batch_sizes.split(",")]:
+            # warm up caches (model loads, reverb impulses, effect bank)
+            run_script(miner, corpus[-1], batch_size, Timings())
+
+            timings = Timings()
+            audio_seconds = 0.0
+            for _ in range(repeat):
+                for script in corpus:
+                    torch.manual_seed(0)
+                    audio_seconds += run_script(miner, script, batch_size,
+                                                timings)
+
+            stages = timings.summary(audio_seconds)
+            results["runs"].append({
+                "threads": thread_count,
+                "batch_size": batch_size,
+                "audio_seconds": audio_seconds,
+                "stages": stages,
+            })
+
+            print("threads=%d batch_size=%d audio=%.1fs" % (
+                thread_count, batch_size, audio_seconds))
+            for stage, stats in stages.items():
+                print("  %-18s n=%-4d p50=%9.2fms p90=%9.2fms p99=%9.2fms rtf=%.4f" % (
+                    stage, stats["count"], stats["p50_ms"], stats["p90_ms"],
+                    stats["p99_ms"], stats["rtf"] or 0))
+
+    with open(output, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    print("Wrote %s" % output)
+
+    if previous is not None:
+        with open(previous) as f:
+            compare(json.loads(f.read()), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Synthesizes the same sentences in every CPU precision mode and reports
+# the real-time factor (synthesis time / audio duration, lower is better)
+# and how close the audio is to float32.
+#
+#   ./benchmarks/precision.py [--speaker udisen] [--threads 4]
+
+import os
+import sys
+import time
+import click
+import numpy as np
+from scipy import signal
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+SAMPLE_RATE = 22050
+
+
+def log_spectrogram(audio: np.ndarray) -> np.ndarray:
+    _, _, spec = signal.stft(audio, SAMPLE_RATE, nperseg=1024, noverlap=768)
+    return np.log10(np.abs(spec).T + 1e-5)
+
+
+def dtw_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Mean log-spectral distance (dB) between two spectrograms after aligning
+    their frames with dynamic time warping, since lower precision can change
+    the timing of the autoregressive decoder.
+    """
+    cost = 20 * np.abs(a[:, None, :] - b[None, :, :]).mean(axis=2)
+    acc = np.full((len(a) + 1, len(b) + 1), np.inf)
+    steps = np.zeros_like(acc)
+    acc[0, 0] = 0
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            k = np.argmin((acc[i - 1, j - 1], acc[i - 1, j], acc[i, j - 1]))
+            prev = [(i - 1, j - 1), (i - 1, j), (i, j - 1)][k]
+            acc[i, j] = cost[i - 1, j - 1] + acc[prev]
+            steps[i, j] = steps[prev] + 1
+    return float(acc[-1, -1] / steps[-1, -1])
+
+
+def spectral_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    # cosine similarity of the average spectra
+    a, b = a.mean(axis=0), b.mean(axis=0)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+@click.command()
+@click.option("--speaker", default="udisen")
+@click.option("--threads", default=4, help="torch CPU threads")
+@click.option("--text", default="example-texts/poem.txt",
+              help="Text file, one utterance per non-empty line")
+@click.option("--lines", default=8, help="Number of lines to synthesize")
+def main(speaker, threads, text, lines):
+    import torch
+    from bitcoin_miner import BitcoinMiner, PRECISIONS
+
+    with open(text) as f:
+        sentences = [line.strip() for line in f if line.strip()][:lines]
+
+    reference = None
+    print("%6s %10s %10s %8s %12s %12s" % ("mode", "audio (s)", "time (s)",
+                                           "RTF", "distance dB", "similarity"))
+    for precision in PRECISIONS:
+        bitcoin_miner = BitcoinMiner(False, threads, use_synthesis_cache=False,
+                                     precision=precision)
+        bitcoin_miner.update_model(speaker)
+
+        # the decoder prenet always applies dropout, use the same noise
+        torch.manual_seed(0)
+        bitcoin_miner.end_to_end_infer(sentences[0], None)  # warm up
+
+        audios = []
+        start = time.perf_counter()
+        for sentence in sentences:
+            torch.manual_seed(0)
+            audios.append(bitcoin_miner.end_to_end_infer(sentence, None)
+                          .float().cpu().numpy())
+        elapsed = time.perf_counter() - start
+        duration = sum(len(audio) for audio in audios) / SAMPLE_RATE
+
+        spectrograms = [log_spectrogram(audio) for audio in audios]
+        if reference is None:
+            reference = spectrograms
+        distance = np.mean([dtw_distance(a, b)
+                            for a, b in zip(reference, spectrograms)])
+        similarity = np.mean([spectral_similarity(a, b)
+                              for a, b in zip(reference, spectrograms)])
+
+        print("%6s %10.2f %10.2f %8.3f %12.2f %12.4f" % (
+            precision, duration, elapsed, elapsed / duration, distance,
+            similarity))
+        del bitcoin_miner
+
+
+if __name__ == "__main__":
+    main()
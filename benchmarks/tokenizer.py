@@ -0,0 +1,163 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Checks that Tokenizer.lex produces the same tokens as the original
+# character by character lexer on random inputs, then compares their
+# throughput on large scripts.
+#
+#   ./benchmarks/tokenizer.py [--fuzz 20000] [--sizes 0.1,1,4]
+
+import os
+import random
+import re
+import sys
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from tokens import Group, Speech, SoundEffect, SoundFilter  # noqa: E402
+from tokenizer import Tokenizer  # noqa: E402
+
+
+class LegacyTokenizer(Tokenizer):
+    # the lexer as it was before TOKEN_RE
+
+    def __init__(self, input_str: str, root: Group) -> None:
+        super().__init__(input_str, root)
+        self.index = -1
+
+    def get_next(self) -> str | None:
+        if self.index < len(self.input_str) - 1:
+            return self.input_str[self.index + 1]
+
+    def move_next(self):
+        next = self.get_next()
+        self.index += 1
+        return next
+
+    def scan_to_delimiter(self, delimiter) -> str | None:
+        ret = ""
+        while self.get_next() != delimiter:
+            c = self.move_next()
+            if c is None:
+                return None
+            ret += c
+
+        self.move_next()
+
+        if len(ret) > 0:
+            return ret
+
+    def lex(self):
+        text = ""
+        while True:
+            c = self.move_next()
+
+            if c is None:
+                yield Speech(self.current_speaker, text)
+                return
+
+            if c in ":":
+                tokens = re.split(" |\\n", text)
+                previous_speech = " ".join(tokens[0:-1])
+                yield Speech(self.current_speaker, previous_speech)
+                self.current_speaker = tokens[-1]
+                text = ""
+            elif c in "{":
+                yield Speech(self.current_speaker, text)
+                text = ""
+
+                index = self.scan_to_delimiter("}")
+                if index:
+                    filter = SoundFilter()
+                    filter.index = index
+                    yield filter
+            elif c in "[":
+                yield Speech(self.current_speaker, text)
+                text = ""
+
+                index = self.scan_to_delimiter("]")
+                if index:
+                    filter = SoundEffect()
+                    try:
+                        filter.index = int(index)
+                        yield filter
+                    except ValueError:
+                        continue
+            else:
+                text += c
+
+
+def describe(token):
+    if isinstance(token, Speech):
+        return ("speech", token.speaker, token.text)
+    return (type(token).__name__, token.index)
+
+
+def lex(tokenizer_class, text):
+    return [describe(t) for t in tokenizer_class(text, Group([])).lex()]
+
+
+def random_script(rng: random.Random, length: int) -> str:
+    alphabet = ["a", "b", "c", " ", " ", "\n", ":", "{", "}", "[", "]",
+                ".", "1", "2", "udisen", "peroni: ", "{1}", "{.}", "[3]"]
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def donation_script(size: int) -> str:
+    # roughly what real scripts look like, repeated up to size characters
+    chunk = ("peroni: are you happy? to steal my voice? {2} fakin tresh. {.} "
+             "[12] udisen: hello today will show how can stream snipe {9} with "
+             "text to speech {.} [3] velcuz: remember to subscribe. ")
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+
+def fuzz(iterations: int) -> int:
+    rng = random.Random(0)
+    failures = 0
+    for i in range(iterations):
+        script = random_script(rng, rng.randint(0, 40))
+        expected = lex(LegacyTokenizer, script)
+        actual = lex(Tokenizer, script)
+        if expected != actual:
+            failures += 1
+            if failures <= 5:
+                print("MISMATCH for %r" % script)
+                print("  legacy: %r" % expected)
+                print("  new:    %r" % actual)
+    return failures
+
+
+@click.command()
+@click.option("--fuzz", "iterations", default=20000,
+              help="Random scripts to compare against the legacy lexer")
+@click.option("--sizes", default="0.1,1,4", help="Script sizes in megabytes")
+def main(iterations, sizes):
+    failures = fuzz(iterations)
+    print("fuzz: %d/%d scripts differ" % (failures, iterations))
+    if failures:
+        sys.exit(1)
+
+    print("%8s %14s %14s %10s" % ("MB", "legacy (MB/s)", "new (MB/s)", "tokens"))
+    for megabytes in [float(x) for x in sizes.split(",")]:
+        script = donation_script(int(megabytes * 1024 * 1024))
+
+        start = time.perf_counter()
+        expected = lex(LegacyTokenizer, script)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = lex(Tokenizer, script)
+        new_time = time.perf_counter() - start
+
+        assert expected == actual
+        print("%8.1f %14.2f %14.2f %10d" % (megabytes, megabytes / legacy_time,
+                                            megabytes / new_time, len(actual)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,63 +5,118 @@
 #
 # Distributed under terms of the GPLv3 license.
 
-from sys import stderr
-
-
 import sys
 import os
+import fcntl
 import json
-import gdown
+import queue
+import re
+import threading
+import time
 import torch
-import numpy as np
 
+import metrics
+import compiled
+from compiled import COMPILE_MODES, compile_method, is_compiled
+from model_cache import ModelCache, model_size
+from prefetch import Prefetcher
+from synthesis_cache import SynthesisCache
+from pronunciation import PronunciationDictionary
+
+EXPORT_PATH = os.path.join("models", "exported")
+
+# CPU inference precisions, CUDA always runs Tacotron2 in half precision
+PRECISIONS = ("fp32", "int8", "bf16")
+
+
+def import_models():
+    # the tacotron2 and hifigan packages pull in librosa, scipy and friends,
+    # so they are only imported once a BitcoinMiner is actually created
+    global create_hparams, Tacotron2, text_to_sequence, AttrDict, Generator
+    if "Generator" in globals():
+        return
+
+    if __name__ == "__main__":
+        from .tacotron2.hparams import create_hparams
+        from .tacotron2.model import Tacotron2
+        from .tacotron2.text import text_to_sequence
+
+        from .hifigan.env import AttrDict
+        from .hifigan.models import Generator
+    else:
+        sys.path.append("hifigan")
+        sys.path.append("tacotron2")
+        from hparams import create_hparams  # type: ignore
+        from model import Tacotron2  # type: ignore
+        from text import text_to_sequence  # type: ignore
 
-if __name__ == "__main__":
-    from .tacotron2.hparams import create_hparams
-    from .tacotron2.model import Tacotron2
-    from .tacotron2.layers import TacotronSTFT
-    from .tacotron2.audio_processing import griffin_lim
-    from .tacotron2.text import text_to_sequence
+        from env import AttrDict  # type: ignore
+        from models import Generator  # type: ignore
 
-    from .hifigan.env import AttrDict
-    from .hifigan.meldataset import MAX_WAV_VALUE
-    from .hifigan.models import Generator
-else:
-    sys.path.append("hifigan")
-    sys.path.append("tacotron2")
-    from hparams import create_hparams  # type: ignore
-    from model import Tacotron2  # type: ignore
-    from layers import TacotronSTFT  # type: ignore
-    from audio_processing import griffin_lim  # type: ignore
-    from text import text_to_sequence  # type: ignore
 
-    from env import AttrDict  # type: ignore
-    from meldataset import MAX_WAV_VALUE  # type: ignore
-    from models import Generator  # type: ignore
+def load_artifact(path, device):
+    # exported artifacts are memory-mapped instead of read into memory
+    try:
+        return torch.load(path, map_location=device, mmap=True,
+                          weights_only=True)
+    except TypeError:
+        # torch < 2.1
+        return torch.load(path, map_location=device)
+
+
+def source_identity(path) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def export_artifact(path, module, source, **extra):
+    # the temporary file is per process so concurrent exports never mix
+    state_dict = {k: v.detach().float().contiguous().cpu()
+                  for k, v in module.state_dict().items()}
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    torch.save({"state_dict": state_dict,
+                "source": source_identity(source), **extra}, tmp)
+    os.replace(tmp, path)
+    print("INFO: exported %s" % path)
 
 
 class BitcoinMiner():
-    thisdict = {}
     HIFIGAN_ID = "1qpgI41wNXFcH-iKq1Y42JlBC9j0je8PW"
     GDRIVE_PREFIX = "https://drive.google.com/uc?id="
 
     model_name = ""
+    model_id = ""
     model = None
     hparams = None
 
     hifigan = None
+    hifigan_dtype = torch.float32
+
+    # every utterance may decode step_budget_base + steps_per_symbol frames
+    # per input symbol (at most max_decoder_steps), and stops early once its
+    # attention has stayed on the last symbol for alignment_end_steps
+    step_budget_base = 100
+    steps_per_symbol = 12
+    alignment_end_steps = 10
+    # trailing frames more than silence_threshold (log amplitude) below the
+    # loudest frame are not vocoded, except for silence_padding of them
+    silence_threshold = 4.6
+    silence_padding = 10
     device: torch.device
+    precision = "fp32"
+    compile_mode = "eager"
 
-    def __init__(self, is_using_cuda=True, cpu_threads=1):
-        # allows user to choose CPU or CUDA inference
-        import os
-        #pbar.update(1) # downloaded TT2 and HiFi-GAN
-        import gdown
+    models: ModelCache
+    prefetcher: Prefetcher | None
+    dictionary: PronunciationDictionary
+    synthesis_cache: SynthesisCache | None
 
-        #import IPython.display as ipd
-        import numpy as np
-        import torch
-        import json
+    def __init__(self, is_using_cuda=True, cpu_threads=1,
+                 model_cache_size=4, model_cache_bytes=None,
+                 use_synthesis_cache=True, precision="fp32",
+                 share_weights=False, prefetch=True, compile_mode="eager"):
+        # allows user to choose CPU or CUDA inference
+        import_models()
 
         if is_using_cuda:
             self.device = torch.device("cuda")
@@ -71,30 +126,104 @@ class BitcoinMiner():
 
         print("INFO: torch.device.type == \"%s\"" % self.device.type)
 
-        self.hifigan, _ = self.get_hifigan()
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision \"%s\"" % precision)
+        if self.device.type == "cpu":
+            self.precision = precision
+            print("INFO: precision == \"%s\"" % precision)
+
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError("Unknown compile mode \"%s\"" % compile_mode)
+        self.compile_mode = compile_mode
+        if compile_mode != "eager":
+            print("INFO: compile_mode == \"%s\"" % compile_mode)
+
+        # exports missing artifacts on first load, see share_artifact()
+        self.share_weights = share_weights
+        if share_weights and (self.device.type != "cpu" or precision != "fp32"):
+            # the reduced or CUDA copies are private to every process
+            print("INFO: only HiFi-GAN and Tacotron2 weights in float32 on "
+                  "CPU are shared between processes")
+
+        # loaded tacotron2 models keyed by speaker name
+        self.models = ModelCache(model_cache_size, model_cache_bytes)
+        # loads upcoming speakers in the background, see prefetch()
+        self.prefetcher = Prefetcher(self) if prefetch else None
+
+        # CMUdict and per-speaker overrides for arpa()
+        self.dictionary = PronunciationDictionary()
+
+        # previously synthesized utterances
+        self.synthesis_cache = SynthesisCache() if use_synthesis_cache else None
+
+        self.hifigan, h = self.get_hifigan()
+        self.hifigan = self.reduce_hifigan_precision(self.hifigan)
+        self.compile_hifigan(self.hifigan, h.num_mels)
 
     def arpa(self, text, punctuation=r"!?,.;", EOS_Token=True):
-        out = ""
-        for word_ in text.split(" "):
-            word = word_
-            end_chars = ""
-            while any(elem in word for elem in punctuation) and len(word) > 1:
-                if word[-1] in punctuation: end_chars = word[-1] + end_chars; word = word[:-1]
-                else: break
-            try:
-                word_arpa = self.thisdict[word.upper()]
-                word = "{" + str(word_arpa) + "}"
-            except KeyError:
-                pass
-            out = (out + " " + word + end_chars).strip()
-        if EOS_Token and out[-1] != ";":
-            out += ";"
-        return out
-
-    def get_hifigan(self):
-        # Download HiFi-GAN
+        return self.dictionary.arpa(text, self.model_name, punctuation,
+                                    EOS_Token)
+
+    def exported_artifact(self, name, source):
+        # returns the exported artifact of source if it is up to date
+        path = os.path.join(EXPORT_PATH, name + ".pt")
+        if not os.path.exists(path):
+            return None
+        artifact = load_artifact(path, self.device)
+        if os.path.exists(source) and artifact["source"] != source_identity(source):
+            print("WARNING: %s is older than %s, run export-models.py" % (path, source))
+            return None
+        return artifact
+
+    def share_artifact(self, name, source, load):
+        """
+        Returns the exported artifact of source, first exporting the module
+        and extra fields returned by load() if there is none. Artifacts are
+        memory-mapped, so every process loading one shares a single copy of
+        its weights in the page cache instead of holding its own.
+        """
+        path = os.path.join(EXPORT_PATH, name + ".pt")
+        os.makedirs(EXPORT_PATH, exist_ok=True)
+        # workers starting together export once and all map the same file
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            artifact = self.exported_artifact(name, source)
+            if artifact is None:
+                module, extra = load()
+                export_artifact(path, module, source, **extra)
+                del module
+                artifact = self.exported_artifact(name, source)
+        return artifact
+
+    def get_hifigan(self, use_exported=True):
         hifimodel_outfile = "hifimodel"
+        artifact = None
+        if use_exported:
+            artifact = self.exported_artifact("hifigan", hifimodel_outfile)
+        if artifact is None and use_exported and self.share_weights:
+            def load():
+                hifigan, h = self.load_hifigan()
+                return hifigan, {"config": dict(h)}
+            artifact = self.share_artifact("hifigan", hifimodel_outfile, load)
+
+        if artifact is not None:
+            h = AttrDict(artifact["config"])
+            # weight norm is already folded into the exported weights
+            hifigan = self.build_module(
+                lambda: Generator(h), artifact["state_dict"],
+                lambda module: module.remove_weight_norm())
+            hifigan.eval()
+            return hifigan, h
+
+        return self.load_hifigan()
+
+    def load_hifigan(self):
+        # loads the checkpoint itself, downloading it first if needed
+        hifimodel_outfile = "hifimodel"
+
+        # Download HiFi-GAN
         if not os.path.exists(hifimodel_outfile):
+            import gdown
             gdown.download(self.GDRIVE_PREFIX + self.HIFIGAN_ID,
                     hifimodel_outfile, quiet=False)
         if not os.path.exists(hifimodel_outfile):
@@ -115,19 +244,67 @@ class BitcoinMiner():
         hifigan.remove_weight_norm()
         return hifigan, h
 
+    def build_module(self, constructor, state_dict, prepare=None):
+        """
+        Builds a module directly from state_dict. The module is created on
+        the meta device so no time is spent on random initialization, and
+        its parameters are the (memory-mapped) tensors of state_dict.
+        """
+        try:
+            with torch.device("meta"):
+                module = constructor()
+                if prepare is not None:
+                    prepare(module)
+            module.load_state_dict(state_dict, assign=True)
+        except (AttributeError, TypeError, NotImplementedError, RuntimeError):
+            # torch < 2.1 has no meta device context or assign
+            module = constructor()
+            if prepare is not None:
+                prepare(module)
+            module.load_state_dict(state_dict)
+        return module.to(self.device)
+
     def has_MMI(self, state_dict):
         return any(True for x in state_dict.keys() if "mi." in x)
 
-    def get_tacotron2(self, model_path):
-        # Download Tacotron2
-        if not os.path.exists(model_path):
-            raise FileNotFoundError("\"%s\" does not exist" % model_path)
-
+    def tacotron2_hparams(self):
         hparams = create_hparams()
         hparams["sampling_rate"] = 22050
         hparams["max_decoder_steps"] = 3000
         hparams["gate_threshold"] = 0.25
+        return hparams
+
+    def get_tacotron2(self, model_path, use_exported=True):
+        name = os.path.basename(model_path)
+        artifact = None
+        if use_exported:
+            artifact = self.exported_artifact(name, model_path)
+
+        # Download Tacotron2
+        if artifact is None and not os.path.exists(model_path):
+            raise FileNotFoundError("\"%s\" does not exist" % model_path)
+
+        hparams = self.tacotron2_hparams()
+
+        if artifact is None and use_exported and self.share_weights:
+            artifact = self.share_artifact(
+                name, model_path,
+                lambda: (self.load_tacotron2(model_path, hparams), {}))
 
+        if artifact is not None:
+            model = self.build_module(lambda: Tacotron2(hparams),
+                                      artifact["state_dict"])
+        else:
+            model = self.load_tacotron2(model_path, hparams)
+        model.to(self.device).eval()
+        if self.device.type != "cpu":
+            model.half()
+        model = self.reduce_tacotron2_precision(model)
+        self.compile_tacotron2(model)
+        return model, hparams
+
+    def load_tacotron2(self, model_path, hparams):
+        # loads the checkpoint itself
         model = Tacotron2(hparams)
 
         state_dict = torch.load(model_path,
@@ -136,45 +313,493 @@ class BitcoinMiner():
         if self.has_MMI(state_dict):
             raise Exception("ERROR: This notebook does not currently support MMI models.")
         model.load_state_dict(state_dict)
-        model.to(self.device).eval()
-        if self.device.type != "cpu":
-            model.half()
-        return model, hparams
+        return model
+
+    def reduce_tacotron2_precision(self, model):
+        if self.precision == "int8":
+            # dynamic quantization of the decoder LSTMs and every linear
+            # layer, convolutions and the embedding stay in float32
+            return torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.LSTM, torch.nn.LSTMCell, torch.nn.Linear},
+                dtype=torch.qint8)
+        if self.precision == "bf16":
+            return model.to(torch.bfloat16)
+        return model
+
+    def reduce_hifigan_precision(self, hifigan):
+        # HiFi-GAN is all convolutions, which dynamic quantization does not
+        # cover, so int8 mode runs it in bfloat16 as well
+        if self.precision in ("int8", "bf16"):
+            self.hifigan_dtype = torch.bfloat16
+            return hifigan.to(torch.bfloat16)
+        return hifigan
+
+    def compile_hifigan(self, hifigan, n_mels):
+        if self.compile_mode == "eager":
+            return
+        start = time.perf_counter()
+        example = torch.zeros(1, n_mels, 32, dtype=self.hifigan_dtype,
+                              device=self.device)
+        # held for the whole warm-up, see compiled.lock
+        with compiled.lock:
+            if compile_method(hifigan, "forward", self.compile_mode, example):
+                # compiles ahead of the first request, with a batch and
+                # length other than the example so that neither is
+                # specialized on
+                with torch.no_grad():
+                    for batch_size, frames in ((1, 32), (2, 64), (1, 48)):
+                        hifigan(example.new_zeros(batch_size, n_mels, frames))
+        if is_compiled(hifigan):
+            print("INFO: compiled HiFi-GAN in %.1fs"
+                  % (time.perf_counter() - start))
+
+    def compile_tacotron2(self, model):
+        """
+        Compiles the decoder prenet and postnet, and with inductor the
+        decoder step itself. torchscript cannot compile the step since it
+        keeps the attention and LSTM states on the decoder between calls.
+        """
+        if self.compile_mode == "eager":
+            return
+        start = time.perf_counter()
+        decoder = model.decoder
+        dtype = model.embedding.weight.dtype
+        n_mels = decoder.n_mel_channels
+        frame = torch.zeros(1, n_mels * decoder.n_frames_per_step,
+                            dtype=dtype, device=self.device)
+        # held for the whole warm-up, which may run on the prefetch thread
+        # while another model decodes, see compiled.lock
+        with compiled.lock:
+            compile_method(decoder.prenet, "forward", self.compile_mode, frame)
+            compile_method(model.postnet, "forward", self.compile_mode,
+                           torch.zeros(1, n_mels, 32, dtype=dtype,
+                                       device=self.device))
+            if self.compile_mode == "inductor":
+                compile_method(decoder, "decode", self.compile_mode)
+
+            # a few steps of a batch of one and of two, like infer_mels
+            with torch.no_grad():
+                for batch_size, length in ((1, 16), (2, 24), (1, 20)):
+                    inputs = torch.ones(batch_size, length, dtype=torch.long,
+                                        device=self.device)
+                    lengths = torch.full((batch_size,), length,
+                                         dtype=torch.long)
+                    memory = model.encoder(
+                        model.embedding(inputs).transpose(1, 2),
+                        lengths.to(self.device))
+                    mask = torch.zeros(batch_size, length, dtype=torch.bool,
+                                       device=self.device)
+                    decoder_input = decoder.get_go_frame(memory)
+                    decoder.initialize_decoder_states(memory, mask=mask)
+                    mel_outputs = []
+                    for _ in range(3):
+                        decoder_input = decoder.prenet(decoder_input)
+                        decoder_input, _, _ = decoder.decode(decoder_input)
+                        mel_outputs.append(decoder_input)
+                    model.postnet(torch.stack(mel_outputs, dim=2))
+
+        done = [is_compiled(decoder.prenet), is_compiled(model.postnet),
+                is_compiled(decoder, "decode")]
+        if any(done):
+            print("INFO: compiled %d Tacotron2 modules in %.1fs"
+                  % (sum(done), time.perf_counter() - start))
+
+    def prepare_text(self, line, pronunciation_dictionary):
+        if not pronunciation_dictionary:
+            if line[-1] != ";":
+                line += ";"
+            return line
+        return self.arpa(line)
+
+    def split_sentences(self, text) -> list[str]:
+        sentences = []
+        for line in text.split("\n"):
+            for sentence in re.split(r"(?<=[.!?;])\s+", line.strip()):
+                if len(sentence):
+                    sentences.append(sentence)
+        return sentences
+
+    def text_to_sequence(self, sentence, pronunciation_dictionary):
+        sentence = self.prepare_text(sentence, pronunciation_dictionary)
+        return text_to_sequence(sentence, ["english_cleaners"])
+
+    def infer_mel(self, sequence, model=None, device=None, speaker=None):
+        # same as Tacotron2.inference, with the stopping rules of infer_mels
+        return self.infer_mels([torch.LongTensor(sequence)], model, device,
+                               speaker)[0][None]
+
+    def step_budget(self, length: int, model=None) -> int:
+        if model is None:
+            model = self.model
+        budget = self.step_budget_base + self.steps_per_symbol * length
+        return min(budget, model.decoder.max_decoder_steps)
+
+    def decoding_identity(self) -> str:
+        # settings that change the audio of a sequence, for cache keys
+        return "%d:%d:%d:%r:%d" % (self.step_budget_base,
+                                   self.steps_per_symbol,
+                                   self.alignment_end_steps,
+                                   self.silence_threshold,
+                                   self.silence_padding)
+
+    def trim_silence(self, mel) -> int:
+        # returns the number of frames of mel to keep
+        energy = mel.float().mean(dim=0)
+        loud = (energy > energy.max() - self.silence_threshold).nonzero()
+        if len(loud) == 0:
+            return mel.size(1)
+        return min(mel.size(1), int(loud[-1]) + 1 + self.silence_padding)
+
+    def record_decoder_stop(self, steps, reason, trimmed, speaker=None):
+        if speaker is None:
+            speaker = self.model_name
+        metrics.DECODER_STEPS.observe(steps, speaker=speaker)
+        metrics.DECODER_STOPS.inc(speaker=speaker, reason=reason)
+        if trimmed > 0:
+            metrics.DECODER_TRIMMED_FRAMES.inc(trimmed, speaker=speaker)
+
+    def run_hifigan(self, mels):
+        start = time.perf_counter()
+        audio = self.hifigan(mels.to(self.hifigan_dtype)).float()
+        if self.device.type == "cuda":
+            # kernels run asynchronously, wait for them to get a real time
+            torch.cuda.current_stream(self.device).synchronize()
+        metrics.HIFIGAN_SECONDS.observe(time.perf_counter() - start,
+                                        batch=mels.size(0))
+        return audio
+
+    def vocode(self, mel):
+        y_g_hat = self.run_hifigan(mel)
+        audio = y_g_hat.squeeze()
+        #audio = audio * MAX_WAV_VALUE FeelsGoodMan Clap
+        return audio
 
     def end_to_end_infer(self, text, pronunciation_dictionary):
+        audios = list(self.stream_infer(text, pronunciation_dictionary))
+        if len(audios) == 0:
+            return None
+        if len(audios) == 1:
+            return audios[0]
+        return torch.cat(audios)
+
+    def stream_infer(self, text, pronunciation_dictionary):
+        """
+        Yields the audio of every sentence of text. With more than one
+        sentence, Tacotron2 decodes the next sentence on a separate thread
+        (and CUDA stream) while HiFi-GAN vocodes the current one.
+        """
         if self.model is None:
             raise Exception("No Tacotron model is loaded")
 
         if self.hifigan is None:
             raise Exception("HifiGAN is not loaded")
 
-        for i in [x for x in text.split("\n") if len(x)]:
-            if not pronunciation_dictionary:
-                if i[-1] != ";":
-                    i += ";" 
-            else:
-                i = self.arpa(i)
+        jobs = []
+        for sentence in self.split_sentences(text):
+            sequence = self.text_to_sequence(sentence, pronunciation_dictionary)
+            jobs.append((sequence, self.cache_key(sequence)))
 
+        if len(jobs) == 1:
+            sequence, key = jobs[0]
+            cached = self.cached_audio(key)
+            if cached is not None:
+                yield cached
+                return
             with torch.no_grad(): # save VRAM by not including gradients
-                sequence = np.array(text_to_sequence(i, ["english_cleaners"]))[None, :]
-                sequence = torch.autograd.Variable(torch.from_numpy(sequence)) \
-                        .to(self.device).long()
-                #mel_outputs, mel_outputs_postnet, _, alignments = self.model.inference(sequence)
-
-                _, mel_outputs_postnet, _, _ = self.model.inference(sequence)
-                #if show_graphs:
-                #    plot_data((mel_outputs_postnet.float().data.cpu().numpy()[0],
-                #            alignments.float().data.cpu().numpy()[0].T))
-                y_g_hat = self.hifigan(mel_outputs_postnet.float())
-                audio = y_g_hat.squeeze()
-                #audio = audio * MAX_WAV_VALUE FeelsGoodMan Clap
-                return audio
+                audio = self.vocode(self.infer_mel(sequence))
+            if key is not None:
+                self.synthesis_cache.put(key, audio.float().cpu().numpy())
+            yield audio
+            return
+
+        # the queue is unbounded so the decoder thread never blocks, even
+        # if the caller stops consuming. The thread keeps the model it was
+        # started with even if another request switches speakers, and stops
+        # after the current utterance once the generator is closed
+        mels = queue.Queue()
+        model, device, speaker = self.model, self.device, self.model_name
+        stop = threading.Event()
+
+        def decode():
+            stream = None
+            if device.type == "cuda":
+                stream = torch.cuda.Stream(device)
+            try:
+                # grad mode is per thread
+                with torch.no_grad():
+                    for sequence, key in jobs:
+                        if stop.is_set():
+                            break
+                        cached = self.cached_audio(key)
+                        if cached is not None:
+                            mels.put((key, cached, None, None))
+                            continue
+                        event = None
+                        if stream is not None:
+                            with torch.cuda.stream(stream):
+                                mel = self.infer_mel(sequence, model, device,
+                                                     speaker)
+                                event = torch.cuda.Event()
+                                event.record(stream)
+                        else:
+                            mel = self.infer_mel(sequence, model, device,
+                                                 speaker)
+                        mels.put((key, None, mel, event))
+            except Exception as e:
+                mels.put(e)
+            mels.put(None)
+
+        thread = threading.Thread(target=decode, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = mels.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                key, audio, mel, event = item
+                if audio is None:
+                    if event is not None:
+                        torch.cuda.current_stream(device).wait_event(event)
+                    with torch.no_grad():
+                        audio = self.vocode(mel)
+                    if key is not None:
+                        self.synthesis_cache.put(key,
+                                                 audio.float().cpu().numpy())
+                yield audio
+        finally:
+            stop.set()
+
+    def cache_key(self, sequence) -> str | None:
+        # identifies the audio of a sequence under the current model
+        if self.synthesis_cache is None:
+            return None
+        return SynthesisCache.key(self.model_id, sequence, self.hparams,
+                                  self.decoding_identity())
+
+    def cached_audio(self, key):
+        if key is None:
+            return None
+        cached = self.synthesis_cache.get(key)
+        if cached is not None:
+            return torch.from_numpy(cached).to(self.device)
+
+    def model_identity(self, model_path) -> str:
+        if not os.path.exists(model_path):
+            # only the exported artifact is available
+            model_path = os.path.join(EXPORT_PATH,
+                                      os.path.basename(model_path) + ".pt")
+        stat = os.stat(model_path)
+        return "%s:%d:%d:%s" % (os.path.realpath(model_path), stat.st_size,
+                                stat.st_mtime_ns, self.precision)
+
+    def infer_mels(self, sequences, model=None, device=None, speaker=None):
+        """
+        Batched version of Tacotron2.inference: takes a list of 1D
+        LongTensors and returns a list of (n_mel_channels, frames) mels.
+        model, device and speaker default to the current ones.
+
+        Each utterance stops at its gate, when its attention reaches the end
+        of the input, or at its step budget, whichever comes first. Trailing
+        silence is trimmed so that HiFi-GAN does not vocode it.
+        """
+        if model is None:
+            model, speaker = self.model, self.model_name
+        if device is None:
+            device = self.device
+        decoder = model.decoder
+
+        # pack_padded_sequence in the encoder wants descending lengths
+        order = sorted(range(len(sequences)),
+                       key=lambda i: len(sequences[i]), reverse=True)
+        lengths = torch.LongTensor([len(sequences[i]) for i in order])
+        padded = torch.zeros(len(order), int(lengths[0]), dtype=torch.long)
+        for row, i in enumerate(order):
+            padded[row, :len(sequences[i])] = sequences[i]
+        padded = padded.to(device)
+
+        embedded_inputs = model.embedding(padded).transpose(1, 2)
+        memory = model.encoder(embedded_inputs, lengths.to(device))
+        mask = (torch.arange(memory.size(1), device=device)[None, :]
+                >= lengths.to(device)[:, None])
+
+        decoder_input = decoder.get_go_frame(memory)
+        decoder.initialize_decoder_states(memory, mask=mask)
+
+        batch_size = len(order)
+        last_symbols = [int(length) - 1 for length in lengths]
+        budgets = [self.step_budget(int(length), model) for length in lengths]
+        mel_lengths = [0] * batch_size
+        end_steps = [0] * batch_size
+        # why each utterance stopped, None while it is still decoding
+        reasons: list[str | None] = [None] * batch_size
+        mel_outputs, gate_outputs, alignments = [], [], []
+        while True:
+            decoder_input = decoder.prenet(decoder_input)
+            mel_output, gate_output, alignment = decoder.decode(decoder_input)
+            mel_outputs += [mel_output.squeeze(1)]
+            gate_outputs += [gate_output]
+            alignments += [alignment]
+
+            gates = torch.sigmoid(gate_output.data).view(-1).tolist()
+            positions = alignment.argmax(dim=1).tolist()
+            for row in range(batch_size):
+                if reasons[row] is not None:
+                    continue
+                mel_lengths[row] += 1
+                if positions[row] >= last_symbols[row]:
+                    end_steps[row] += 1
+                else:
+                    end_steps[row] = 0
+
+                if gates[row] > decoder.gate_threshold:
+                    reasons[row] = "gate"
+                elif end_steps[row] >= self.alignment_end_steps:
+                    reasons[row] = "alignment"
+                elif mel_lengths[row] >= budgets[row]:
+                    print("WARNING: utterance reached its budget of %d "
+                          "decoder steps" % budgets[row])
+                    reasons[row] = "budget"
+
+            if all(reason is not None for reason in reasons):
+                break
+            decoder_input = mel_output
+
+        mel_outputs, _, _ = decoder.parse_decoder_outputs(
+            mel_outputs, gate_outputs, alignments)
+        mel_outputs_postnet = mel_outputs + model.postnet(mel_outputs)
+
+        mels = [None] * batch_size
+        for row, i in enumerate(order):
+            mel = mel_outputs_postnet[row, :, :mel_lengths[row]]
+            frames = self.trim_silence(mel)
+            self.record_decoder_stop(mel_lengths[row], reasons[row],
+                                     mel_lengths[row] - frames, speaker)
+            mels[i] = mel[:, :frames]
+        return mels
+
+    def batch_infer(self, texts, pronunciation_dictionary=None, batch_size=8):
+        """
+        Synthesizes several texts with the currently loaded model, running
+        Tacotron2 and HiFi-GAN over padded batches of up to batch_size
+        utterances. Returns one audio tensor per text, in the same order.
+        """
+        if self.model is None:
+            raise Exception("No Tacotron model is loaded")
+
+        if self.hifigan is None:
+            raise Exception("HifiGAN is not loaded")
+
+        hop_length = self.hparams["hop_length"]
+
+        # every sentence of every text is its own utterance in the batch
+        owners, keys, audios = [], [], []
+        pending = []
+        for index, text in enumerate(texts):
+            for sentence in self.split_sentences(text):
+                sequence = self.text_to_sequence(sentence,
+                                                 pronunciation_dictionary)
+                item = len(owners)
+                owners.append(index)
+                keys.append(self.cache_key(sequence))
+                audios.append(None)
+                audios[item] = self.cached_audio(keys[item])
+                if audios[item] is not None:
+                    continue
+                pending.append((item, torch.LongTensor(sequence)))
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            sequences = [sequence for _, sequence in chunk]
+
+            with torch.no_grad():
+                mels = self.infer_mels(sequences)
+
+                # pad with the quietest value of the batch so that HiFi-GAN
+                # does not pick up noise from neighbouring frames
+                frames = max(mel.size(1) for mel in mels)
+                floor = min(mel.min().item() for mel in mels)
+                batch = torch.full((len(mels), mels[0].size(0), frames),
+                                   floor, device=self.device)
+                for row, mel in enumerate(mels):
+                    batch[row, :, :mel.size(1)] = mel.float()
+
+                y_g_hat = self.run_hifigan(batch)
+                for row, mel in enumerate(mels):
+                    item = chunk[row][0]
+                    audios[item] = y_g_hat[row, 0, :mel.size(1) * hop_length]
+                    if keys[item] is not None:
+                        self.synthesis_cache.put(
+                            keys[item], audios[item].float().cpu().numpy())
+
+        results = []
+        for index in range(len(texts)):
+            parts = [audio for owner, audio in zip(owners, audios)
+                     if owner == index]
+            if len(parts) == 0:
+                results.append(None)
+            elif len(parts) == 1:
+                results.append(parts[0])
+            else:
+                results.append(torch.cat(parts))
+        return results
+
+    def has_model(self, model_name) -> bool:
+        # whether model_name names a model inside models/
+        if model_name in ("", ".", "..") or \
+                model_name != os.path.basename(model_name):
+            return False
+        return (model_name in self.models
+                or os.path.isfile(os.path.join("models", model_name))
+                or os.path.isfile(os.path.join(EXPORT_PATH, model_name + ".pt")))
+
+    def load_model(self, model_name):
+        # returns (model, hparams) from the cache, loading it if necessary
+        cached = self.models.get(model_name)
+        if cached is None:
+            print("Updating models...")
+            start = time.perf_counter()
+            cached = self.get_tacotron2("models/" + model_name)
+            # only labeled once the speaker is known to exist
+            metrics.MODEL_LOAD_SECONDS.observe(time.perf_counter() - start,
+                                               speaker=model_name)
+            # do not evict what the prefetcher loaded for upcoming speakers
+            keep = {self.model_name}
+            if self.prefetcher is not None:
+                keep |= self.prefetcher.planned()
+            self.models.put(model_name, cached, model_size(cached[0]), keep)
+        return cached
+
+    def pin_model(self, model_name):
+        # keep a hot speaker loaded regardless of LRU order
+        self.load_model(model_name)
+        self.models.pin(model_name)
+
+    def unpin_model(self, model_name):
+        self.models.unpin(model_name)
+
+    def close(self):
+        # stops the prefetch thread, dropping loads that have not started
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+    def prefetch(self, speakers):
+        # starts loading the models of speakers, in the order they will be
+        # used, while the current one synthesizes
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(speakers)
 
     def update_model(self, model_name):
         # don't update if requested model is the same as the current one
         if self.model_name != model_name:
-            if self.model is not None:
-                del self.model
-            print("Updating models...")
-            self.model, self.hparams = self.get_tacotron2("models/" + model_name)
+            if self.prefetcher is not None:
+                self.prefetcher.wait(model_name)
+            cached = "true" if model_name in self.models else "false"
+            self.model, self.hparams = self.load_model(model_name)
+            metrics.MODEL_SWITCHES.inc(speaker=model_name, cached=cached)
             self.model_name = model_name
+            self.model_id = self.model_identity("models/" + model_name)
+            if self.prefetcher is not None:
+                self.prefetcher.switched(model_name)
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Compiled execution of single methods of a module. The compiled version
+# replaces the method on the instance, so callers and state_dict() are
+# unchanged, and the eager method is used again if compiling fails.
+
+import threading
+import torch
+
+# "torchscript" traces stateless modules, "inductor" uses torch.compile
+COMPILE_MODES = ("eager", "torchscript", "inductor")
+
+# dynamo is not thread-safe and may recompile on any call with new shapes,
+# so compiling, warming up and calling compiled methods are serialized, also
+# between the prefetch thread, the stream decoder and pool threads
+lock = threading.RLock()
+
+
+class Fallback():
+    """
+    Calls compiled, or function itself once compiled raised. torch.compile
+    only compiles on the first call with new shapes, so its errors show up
+    here and not when it is applied.
+    """
+
+    name: str
+
+    def __init__(self, name, function, compiled) -> None:
+        self.name = name
+        self.function = function
+        self.compiled = compiled
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            with lock:
+                try:
+                    if self.compiled is not None:
+                        return self.compiled(*args, **kwargs)
+                except Exception as e:
+                    print("WARNING: compiled %s failed, running it in eager "
+                          "mode: %s" % (self.name, e))
+                    self.compiled = None
+        return self.function(*args, **kwargs)
+
+
+def compile_method(module, method: str, mode: str, example=None):
+    """
+    Replaces module.method by a compiled version. torchscript traces it
+    with the example inputs, which only works if it keeps no state between
+    calls. Returns False (and leaves the method alone) if it cannot be
+    compiled.
+    """
+    name = "%s.%s" % (type(module).__name__, method)
+    function = getattr(module, method)
+    with lock:
+        try:
+            if mode == "inductor":
+                compiled = torch.compile(function, dynamic=True)
+            elif mode == "torchscript":
+                if method != "forward":
+                    raise ValueError("only forward can be traced")
+                with torch.no_grad():
+                    compiled = torch.jit.trace(module, example,
+                                               check_trace=False)
+            else:
+                raise ValueError("Unknown compile mode \"%s\"" % mode)
+        except Exception as e:
+            print("WARNING: cannot compile %s, running it in eager mode: %s"
+                  % (name, e))
+            return False
+        setattr(module, method, Fallback(name, function, compiled))
+    return True
+
+def is_compiled(module, method="forward") -> bool:
+    # whether a compiled version is set and has not failed
+    function = module.__dict__.get(method)
+    return isinstance(function, Fallback) and function.compiled is not None
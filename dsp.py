@@ -0,0 +1,267 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# In-process implementations of the sox effects used by the built-in sound
+# filters. Every effect takes and returns mono float32 sample arrays.
+
+from fractions import Fraction
+from functools import lru_cache
+from typing import Callable
+import numpy as np
+from scipy import signal
+
+
+# freeverb delay line lengths at 44.1 kHz, same as sox's reverb.c
+COMB_LENGTHS = (1116, 1188, 1277, 1356, 1422, 1491, 1557, 1617)
+ALLPASS_LENGTHS = (225, 341, 441, 556)
+
+
+def gain(samples: np.ndarray, gain_db: float, normalize=True):
+    # same as sox.Transformer.gain, which normalizes by default
+    if normalize:
+        peak = np.abs(samples).max(initial=0)
+        if peak > 0:
+            samples = samples / peak
+    samples = samples * 10 ** (gain_db / 20)
+    return np.clip(samples, -1, 1).astype(np.float32)
+
+
+def biquad(samples: np.ndarray, b, a):
+    return signal.lfilter(b, a, samples).astype(np.float32)
+
+
+def highpass(samples: np.ndarray, sample_rate: int, frequency: float, q=0.707):
+    w0 = 2 * np.pi * frequency / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos = np.cos(w0)
+    b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+    a = [1 + alpha, -2 * cos, 1 - alpha]
+    return biquad(samples, b, a)
+
+
+def lowpass(samples: np.ndarray, sample_rate: int, frequency: float, q=0.707):
+    w0 = 2 * np.pi * frequency / sample_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos = np.cos(w0)
+    b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+    a = [1 + alpha, -2 * cos, 1 - alpha]
+    return biquad(samples, b, a)
+
+
+def shelf(samples: np.ndarray, sample_rate: int, gain_db: float,
+          frequency: float, slope: float, high: bool):
+    # RBJ shelving filter, like sox's bass and treble effects
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * np.pi * frequency / sample_rate
+    cos = np.cos(w0)
+    alpha = np.sin(w0) / 2 * np.sqrt((A + 1 / A) * (1 / slope - 1) + 2)
+    k = 2 * np.sqrt(A) * alpha
+    sign = -1 if high else 1
+    b = [A * ((A + 1) - sign * (A - 1) * cos + k),
+         sign * 2 * A * ((A - 1) - sign * (A + 1) * cos),
+         A * ((A + 1) - sign * (A - 1) * cos - k)]
+    a = [(A + 1) + sign * (A - 1) * cos + k,
+         -sign * 2 * ((A - 1) + sign * (A + 1) * cos),
+         (A + 1) + sign * (A - 1) * cos - k]
+    return biquad(samples, b, a)
+
+
+def bass(samples: np.ndarray, sample_rate: int, gain_db: float,
+         frequency=100.0, slope=0.5):
+    return shelf(samples, sample_rate, gain_db, frequency, slope, False)
+
+
+def treble(samples: np.ndarray, sample_rate: int, gain_db: float,
+           frequency=3000.0, slope=0.5):
+    return shelf(samples, sample_rate, gain_db, frequency, slope, True)
+
+
+def pad(samples: np.ndarray, sample_rate: int, start: float, end: float):
+    return np.pad(samples, (int(start * sample_rate), int(end * sample_rate)))
+
+
+def reverse(samples: np.ndarray):
+    return samples[::-1].copy()
+
+
+@lru_cache(maxsize=16)
+def reverb_impulse(sample_rate: int, reverberance: float,
+                   high_freq_damping: float, room_scale: float,
+                   wet_gain: float) -> np.ndarray:
+    """
+    Impulse response of sox's freeverb network (8 damped comb filters in
+    parallel followed by 4 allpass filters). The filters are evaluated in
+    the frequency domain so the response can be applied with a single FFT
+    convolution instead of running the feedback loops sample by sample.
+    """
+    scale = room_scale / 100 * .9 + .1
+    a = -1 / np.log(1 - .3)
+    b = 100 / (np.log(1 - .98) * a + 1)
+    feedback = 1 - np.exp((reverberance - b) / (a * b))
+    damping = high_freq_damping / 100 * .3 + .2
+    wet = 10 ** (wet_gain / 20) * .015
+
+    r = sample_rate / 44100
+    combs = [int(scale * r * n + .5) for n in COMB_LENGTHS]
+    allpasses = [int(r * n + .5) for n in ALLPASS_LENGTHS]
+
+    # long enough for the slowest comb to decay by 80 dB
+    length = int(max(combs) * np.log(1e-4) / np.log(max(feedback, 1e-3)))
+    length += sum(allpasses) * 14
+    size = 1 << int(np.ceil(np.log2(2 * length)))
+
+    w = -2j * np.pi * np.fft.rfftfreq(size)
+    z1 = np.exp(w)
+    response = np.zeros_like(z1)
+    for n in combs:
+        zn = np.exp(w * n)
+        response += zn * (1 - damping * z1) / \
+            (1 - damping * z1 - feedback * (1 - damping) * zn)
+    for n in allpasses:
+        zn = np.exp(w * n)
+        response *= zn / (1 - .5 * zn) - 1
+
+    return (np.fft.irfft(response, size)[:length] * wet).astype(np.float32)
+
+
+def reverb(samples: np.ndarray, sample_rate: int, reverberance=50,
+           high_freq_damping=50, room_scale=100, pre_delay=0, wet_gain=0,
+           wet_only=False):
+    # same defaults as sox.Transformer.reverb, keeps the input length
+    impulse = reverb_impulse(sample_rate, reverberance, high_freq_damping,
+                             room_scale, wet_gain)
+    delay = int(pre_delay / 1000 * sample_rate + .5)
+    wet = signal.oaconvolve(samples, impulse)[:max(len(samples) - delay, 0)]
+    wet = np.pad(wet, (delay, 0))
+    if wet_only:
+        return wet.astype(np.float32)
+    return (samples + wet).astype(np.float32)
+
+
+def tempo(samples: np.ndarray, sample_rate: int, factor: float,
+          segment_ms=82, search_ms=14.68, overlap_ms=12):
+    """
+    Changes the speed without changing the pitch using WSOLA, with the same
+    segment, search and overlap defaults as sox's tempo effect.
+    """
+    segment = int(sample_rate * segment_ms / 1000 + .5)
+    search = int(sample_rate * search_ms / 1000 + .5)
+    overlap = int(sample_rate * overlap_ms / 1000 + .5)
+    hop_out = segment - overlap
+    hop_in = hop_out * factor
+
+    length = int(len(samples) / factor + .5)
+    frames = length // hop_out + 1
+    padded = np.pad(samples, (search, segment + search + int(hop_in) + 1))
+    out = np.zeros(frames * hop_out + segment, dtype=np.float32)
+
+    fade_in = np.linspace(0, 1, overlap, endpoint=False, dtype=np.float32)
+    fade_out = 1 - fade_in
+
+    tail = None
+    for k in range(frames):
+        start = search + int(k * hop_in + .5)
+        if tail is None:
+            best = start
+        else:
+            # align with the natural continuation of the previous segment
+            region = padded[start - search:start + search + overlap]
+            corr = np.correlate(region, tail, mode="valid")
+            best = start - search + int(np.argmax(corr))
+
+        seg = padded[best:best + segment]
+        pos = k * hop_out
+        if tail is None:
+            out[pos:pos + segment] = seg
+        else:
+            out[pos:pos + overlap] = tail * fade_out + seg[:overlap] * fade_in
+            out[pos + overlap:pos + segment] = seg[overlap:]
+        tail = seg[hop_out:]
+
+    return out[:length]
+
+
+def resample(samples: np.ndarray, ratio: float):
+    # output length is len(samples) * ratio
+    fraction = Fraction(ratio).limit_denominator(1000)
+    return signal.resample_poly(samples, fraction.numerator,
+                                fraction.denominator).astype(np.float32)
+
+
+def pitch(samples: np.ndarray, sample_rate: int, n_semitones: float):
+    # stretch then resample back to the original length, like sox
+    factor = 2 ** (n_semitones / 12)
+    stretched = tempo(samples, sample_rate, 1 / factor)
+    return resample(stretched, 1 / factor)
+
+
+def chorus(samples: np.ndarray, sample_rate: int, gain_in=0.5, gain_out=0.9,
+           delays=(40, 50, 60), decays=(0.3, 0.35, 0.4),
+           speeds=(0.25, 0.325, 0.4), depths=(1, 2, 3),
+           shapes=("s", "t", "s")):
+    """
+    sox's chorus: every voice is a copy of the input delayed by delay ms
+    plus up to depth ms of sinusoidal ("s") or triangular ("t") modulation.
+    sox.Transformer.chorus picks the voice parameters at random, here they
+    are fixed to the middle of the same ranges so output is reproducible.
+    """
+    if len(samples) == 0:
+        # np.interp needs at least one point
+        return samples
+    longest = max(d + m for d, m in zip(delays, depths))
+    tail = int(longest / 1000 * sample_rate) + 1
+    n = np.arange(len(samples) + tail)
+    source = np.arange(len(samples))
+
+    out = np.zeros(len(n), dtype=np.float32)
+    out[:len(samples)] = samples * gain_in
+    for delay, decay, speed, depth, shape in zip(delays, decays, speeds,
+                                                 depths, shapes):
+        phase = (n * speed / sample_rate) % 1
+        if shape == "t":
+            wave = 1 - np.abs(2 * phase - 1)
+        else:
+            wave = (1 + np.sin(2 * np.pi * phase)) / 2
+        offset = (delay + depth * wave) / 1000 * sample_rate
+        out += decay * np.interp(n - offset, source, samples, left=0, right=0)
+    return out * gain_out
+
+
+FILTERS: dict[str, Callable[[np.ndarray, int], np.ndarray]] = {
+    # room echo
+    "1": lambda x, sr: reverb(x, sr, 50, room_scale=25),
+    # hall echo
+    "2": lambda x, sr: reverb(x, sr, 75, room_scale=75, wet_gain=1),
+    # outside echo
+    "3": lambda x, sr: reverb(x, sr, 5, room_scale=5),
+    # pitch down half an octave
+    "4": lambda x, sr: pitch(x, sr, -6),
+    # pitch up half an octave
+    "5": lambda x, sr: pitch(x, sr, 6),
+    # telephone
+    "6": lambda x, sr: gain(highpass(x, sr, 800), 2),
+    # muffled
+    "7": lambda x, sr: gain(lowpass(x, sr, 1200), 1),
+    # quieter
+    "8": lambda x, sr: gain(x, -4),
+    # ghost
+    "9": lambda x, sr: reverb(reverse(reverb(reverse(pad(x, sr, 0.5, 0.5)),
+                                             sr, 50, wet_gain=1)), sr),
+    # chorus
+    "10": lambda x, sr: chorus(x, sr),
+    # slow down
+    "11": lambda x, sr: tempo(x, sr, 0.5),
+    # speed up
+    "12": lambda x, sr: tempo(x, sr, 1.5),
+}
+
+
+def apply_filter(index: str, samples: np.ndarray, sample_rate: int):
+    # returns None if there is no built-in filter with this index
+    if index not in FILTERS:
+        return None
+    return FILTERS[index](samples, sample_rate).astype(np.float32, copy=False)
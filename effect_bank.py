@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+import fcntl
+import json
+import os
+import threading
+import numpy as np
+import sox
+
+
+class EffectBank():
+    """
+    Sound effects decoded and resampled once into raw float32 files under
+    cache_path, which are memory-mapped and served directly afterwards. An
+    effect is decoded again whenever its source file's mtime changes.
+    """
+
+    effects_path: str
+    cache_path: str
+    sample_rate: int
+
+    def __init__(self, effects_path, cache_path=".cache/sound-effects",
+                 sample_rate=22050) -> None:
+        self.effects_path = effects_path
+        self.cache_path = cache_path
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.index: dict[str, dict] = {}
+        self.effects: dict[str, np.ndarray] = {}
+        self.load()
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.cache_path, "index.json")
+
+    def data_file(self, name: str) -> str:
+        return os.path.join(self.cache_path, name + ".f32")
+
+    def read_index(self) -> dict[str, dict]:
+        # effects in the index file, if it is for this sample rate
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            index = json.loads(f.read())
+        if index.get("sample_rate") != self.sample_rate:
+            return {}
+        return index["effects"]
+
+    def load(self):
+        # map everything that was decoded by a previous run
+        for name, entry in self.read_index().items():
+            if os.path.exists(self.data_file(name)):
+                self.index[name] = entry
+                self.effects[name] = self.map(name, entry["length"])
+
+    def save(self, name: str):
+        """
+        Adds the entry of name to the index file. Other processes may share
+        the cache, so the file is read and written under a lock and their
+        entries are kept.
+        """
+        os.makedirs(self.cache_path, exist_ok=True)
+        with open(self.index_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            effects = self.read_index()
+            effects[name] = self.index[name]
+            tmp = "%s.%d.tmp" % (self.index_file, os.getpid())
+            with open(tmp, "w") as f:
+                f.write(json.dumps({
+                    "sample_rate": self.sample_rate,
+                    "effects": effects,
+                }))
+            os.replace(tmp, self.index_file)
+
+    def map(self, name: str, length: int) -> np.ndarray:
+        if length == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.memmap(self.data_file(name), dtype=np.float32, mode="r",
+                         shape=(length,))
+
+    def find_source(self, name: str) -> str | None:
+        mp3_file = f"{self.effects_path}/{name}.mp3"
+        wav_file = f"{self.effects_path}/{name}.wav"
+        if os.path.exists(mp3_file):
+            return mp3_file
+        elif os.path.exists(wav_file):
+            return wav_file
+
+    def decode(self, source: str) -> np.ndarray:
+        samples = (sox
+                   .Transformer()
+                   .convert(samplerate=self.sample_rate, n_channels=1)
+                   .build_array(input_filepath=source))
+        if np.issubdtype(samples.dtype, np.integer):
+            samples = samples / np.iinfo(samples.dtype).max
+        if samples.ndim > 1:
+            samples = samples.mean(axis=1)
+        return samples.astype(np.float32)
+
+    def build(self, name: str, source: str, mtime: float) -> np.ndarray:
+        print("INFO: decoding sound effect %s" % source)
+        samples = self.decode(source)
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        # per process, threads are serialized by self.lock
+        tmp = "%s.%d.tmp" % (self.data_file(name), os.getpid())
+        samples.tofile(tmp)
+        os.replace(tmp, self.data_file(name))
+
+        self.index[name] = {
+            "source": source,
+            "mtime": mtime,
+            "length": len(samples),
+        }
+        self.save(name)
+        return self.map(name, len(samples))
+
+    def get(self, name) -> np.ndarray | None:
+        name = str(name)
+        source = self.find_source(name)
+        if source is None:
+            return None
+        mtime = os.path.getmtime(source)
+
+        with self.lock:
+            entry = self.index.get(name)
+            if (entry is None or entry["source"] != source
+                    or entry["mtime"] != mtime or name not in self.effects):
+                self.effects[name] = self.build(name, source, mtime)
+            return self.effects[name]
+
+    def preload(self):
+        # decode every effect up front so requests never have to
+        if not os.path.exists(self.effects_path):
+            return
+        for file in sorted(os.listdir(self.effects_path)):
+            name, ext = os.path.splitext(file)
+            if ext in (".mp3", ".wav"):
+                self.get(name)
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+import io
+import struct
+import numpy as np
+import soundfile as sf
+
+import dsp
+
+
+# sizes written in the header of a wav stream whose length is unknown
+UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+def wav_stream_header(sample_rate: int, channels=1) -> bytes:
+    """
+    Header of a 16-bit PCM wav file with the RIFF and data chunk sizes left
+    unknown, so samples can be appended as they are synthesized. Players
+    like mpv and ffmpeg read until the end of the stream.
+    """
+    bits = 16
+    block_align = channels * bits // 8
+    return (b"RIFF" + struct.pack("<I", UNKNOWN_SIZE) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate,
+                                    sample_rate * block_align, block_align,
+                                    bits)
+            + b"data" + struct.pack("<I", UNKNOWN_SIZE))
+
+
+def pcm16(samples: np.ndarray) -> bytes:
+    samples = np.clip(samples, -1, 1) * 32767
+    return samples.astype("<i2").tobytes()
+
+
+class AudioFormat():
+    name: str
+    # soundfile format and subtype
+    format: str
+    subtype: str
+    mimetype: str
+    # rate the encoder needs, None to keep the rate of the samples
+    sample_rate: int | None
+
+    def __init__(self, name, format, subtype, mimetype, sample_rate=None) -> None:
+        self.name = name
+        self.format = format
+        self.subtype = subtype
+        self.mimetype = mimetype
+        self.sample_rate = sample_rate
+
+
+FORMATS = {
+    "wav": AudioFormat("wav", "WAV", "PCM_16", "audio/wav"),
+    "flac": AudioFormat("flac", "FLAC", "PCM_16", "audio/flac"),
+    # Opus only supports 8, 12, 16, 24 and 48 kHz
+    "opus": AudioFormat("opus", "OGG", "OPUS", "audio/ogg; codecs=opus", 24000),
+    "ogg": AudioFormat("ogg", "OGG", "VORBIS", "audio/ogg"),
+    "mp3": AudioFormat("mp3", "MP3", "MPEG_LAYER_III", "audio/mpeg"),
+}
+
+# Accept header types of each format, in order of preference for */*
+ACCEPT_TYPES = {
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "audio/ogg;codecs=opus": "opus",
+    "audio/opus": "opus",
+    "audio/ogg": "ogg",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+}
+
+
+def format_of(path: str, default="wav") -> str:
+    # format name from the extension of path
+    extension = path.rsplit(".", 1)[-1].lower() if "." in path else ""
+    return extension if extension in FORMATS else default
+
+
+def encode(samples: np.ndarray, sample_rate: int, format="wav") -> bytes:
+    """
+    Encodes mono float samples in memory. Samples are resampled first if
+    the encoder does not support sample_rate.
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown format \"%s\"" % format)
+    audio_format = FORMATS[format]
+    rate = audio_format.sample_rate or sample_rate
+    if rate != sample_rate:
+        samples = dsp.resample(samples, rate / sample_rate)
+    out = io.BytesIO()
+    sf.write(out, np.clip(samples, -1, 1), rate, format=audio_format.format,
+             subtype=audio_format.subtype)
+    return out.getvalue()
+
+
+def write(path: str, samples: np.ndarray, sample_rate: int, format=None):
+    with open(path, "wb") as f:
+        f.write(encode(samples, sample_rate, format or format_of(path)))
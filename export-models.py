@@ -0,0 +1,34 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Writes inference-ready copies of HiFi-GAN (with weight norm already
+# removed) and of every Tacotron2 model in models/ to models/exported.
+# BitcoinMiner memory-maps these instead of unpickling the checkpoints.
+
+import os
+import sys
+from bitcoin_miner import BitcoinMiner, EXPORT_PATH, export_artifact
+
+
+if not os.path.exists(EXPORT_PATH):
+    os.makedirs(EXPORT_PATH)
+
+bitcoin_miner = BitcoinMiner(False, use_synthesis_cache=False)
+
+hifigan, h = bitcoin_miner.get_hifigan(use_exported=False)
+export_artifact(os.path.join(EXPORT_PATH, "hifigan.pt"), hifigan,
+                "hifimodel", config=dict(h))
+
+# export only the given speakers, or all of them
+speakers = sys.argv[1:] or sorted(os.listdir("models"))
+for speaker in speakers:
+    model_path = os.path.join("models", speaker)
+    if not os.path.isfile(model_path):
+        continue
+    model, _ = bitcoin_miner.get_tacotron2(model_path, use_exported=False)
+    export_artifact(os.path.join(EXPORT_PATH, speaker + ".pt"), model,
+                    model_path)
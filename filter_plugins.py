@@ -0,0 +1,275 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+# Custom sound filters that stay loaded between uses instead of being
+# started for every {name} token.
+#
+# Python modules in sound-filters/ that define a top-level
+#
+#     def process(samples, sample_rate):
+#         return samples  # or (samples, sample_rate)
+#
+# are imported once and called with mono float32 numpy arrays. Every call
+# gets its own writable copy, so process may work in place.
+#
+# Other executables that mention --pcm-stream are started once with that
+# flag and kept running. The protocol is:
+#
+#   - on startup the worker writes "PCM-STREAM 1\n" to stdout, within
+#     HANDSHAKE_TIMEOUT seconds
+#   - every request is one chunk on stdin: a little-endian uint32 sample
+#     rate and uint32 sample count, followed by that many little-endian
+#     float32 mono samples
+#   - the worker answers every chunk with exactly one chunk in the same
+#     format on stdout, at any sample rate and length. It may write its
+#     answer while it is still reading the request
+#   - chunks are sent one at a time, the next one only after the answer.
+#     An answer that takes longer than CHUNK_TIMEOUT seconds, or malformed
+#     output, gets the worker killed; it is started again for the next
+#     chunk. The worker should exit when stdin is closed
+#
+# Anything else is run as before with input and output files as arguments.
+
+import ast
+import importlib.util
+import os
+import re
+import select
+import struct
+import subprocess
+import threading
+import time
+import numpy as np
+
+import dsp
+
+
+FLAG = "--pcm-stream"
+HANDSHAKE = b"PCM-STREAM 1\n"
+CHUNK_HEADER = struct.Struct("<II")
+# seconds a worker has to answer the handshake and to answer a chunk
+HANDSHAKE_TIMEOUT = 5
+CHUNK_TIMEOUT = 30
+
+
+def filter_path(filters_path: str, name: str) -> str | None:
+    # path of the filter name, None unless it is a file name inside
+    # filters_path (names come from requests)
+    if (name in ("", ".", "..") or os.sep in name or "/" in name
+            or ".." in name or os.path.isabs(name)):
+        return None
+    root = os.path.realpath(filters_path)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.dirname(path) != root:
+        return None
+    return os.path.join(filters_path, name)
+
+
+def defines_process(path: str) -> bool:
+    # checks for process() without importing, since importing a plain
+    # script would run it
+    try:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+        return False
+    return any(isinstance(node, ast.FunctionDef) and node.name == "process"
+               for node in tree.body)
+
+
+def supports_pcm_stream(path: str) -> bool:
+    # executables opt in by mentioning the flag, so that scripts which do
+    # not know it are never started with it
+    if not os.access(path, os.X_OK):
+        return False
+    with open(path, "rb") as f:
+        return FLAG.encode() in f.read(1 << 20)
+
+
+def read_exactly(stream, size: int, deadline: float) -> bytes:
+    # reads size bytes from an unbuffered stream before the monotonic
+    # deadline
+    data = bytearray()
+    while len(data) < size:
+        remaining = deadline - time.monotonic()
+        ready, _, _ = select.select([stream], [], [], max(remaining, 0))
+        if not ready:
+            raise TimeoutError("Filter worker did not answer in time")
+        read = os.read(stream.fileno(), min(size - len(data), 1 << 16))
+        if len(read) == 0:
+            raise EOFError("Filter worker closed its output")
+        data += read
+    return bytes(data)
+
+
+def write_all(stream, data: bytes):
+    # the worker may be killed meanwhile, process() then reports the error
+    view = memoryview(data)
+    try:
+        while len(view) > 0:
+            view = view[os.write(stream.fileno(), view):]
+    except OSError:
+        pass
+
+
+class ModulePlugin():
+    path: str
+
+    def __init__(self, path) -> None:
+        self.path = path
+        name = "sound_filter_" + re.sub(r"\W", "_", os.path.basename(path))
+        spec = importlib.util.spec_from_file_location(name, path)
+        if spec is None or spec.loader is None:
+            raise ImportError("Cannot import \"%s\"" % path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+    def process(self, samples, sample_rate):
+        # samples may be a read-only view of a cached sound effect
+        return self.module.process(np.array(samples, dtype=np.float32),
+                                   sample_rate)
+
+    def close(self):
+        pass
+
+
+class PipeWorker():
+    """
+    A long-lived filter executable speaking the PCM stream protocol. It is
+    started on first use and restarted if it dies or hangs. Chunks are sent
+    one at a time, from a separate thread, so that a worker answering while
+    it reads never blocks on a full pipe.
+    """
+
+    path: str
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.worker: subprocess.Popen | None = None
+
+    def start(self):
+        worker = subprocess.Popen([self.path, FLAG], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, bufsize=0)
+        try:
+            line = read_exactly(worker.stdout, len(HANDSHAKE),
+                                time.monotonic() + HANDSHAKE_TIMEOUT)
+        except (OSError, EOFError):
+            line = b""
+        if line != HANDSHAKE:
+            worker.kill()
+            worker.wait()
+            raise Exception("%s did not answer the %s handshake"
+                            % (self.path, FLAG))
+        print("INFO: started filter worker %s" % self.path)
+        self.worker = worker
+
+    def process(self, samples, sample_rate):
+        with self.lock:
+            if self.worker is None or self.worker.poll() is not None:
+                self.start()
+            worker = self.worker
+            samples = np.ascontiguousarray(samples, dtype="<f4")
+            chunk = CHUNK_HEADER.pack(sample_rate, len(samples)) + \
+                samples.tobytes()
+            writer = threading.Thread(target=write_all,
+                                      args=(worker.stdin, chunk), daemon=True)
+            writer.start()
+            deadline = time.monotonic() + CHUNK_TIMEOUT
+            try:
+                rate, count = CHUNK_HEADER.unpack(
+                    read_exactly(worker.stdout, CHUNK_HEADER.size, deadline))
+                data = read_exactly(worker.stdout, count * 4, deadline)
+                writer.join(max(deadline - time.monotonic(), 0))
+                if writer.is_alive():
+                    raise TimeoutError("Filter worker answered before "
+                                       "reading the whole chunk")
+            except (OSError, EOFError):
+                # kills a hung worker too, the next chunk starts a new one
+                self.close()
+                writer.join()
+                raise
+        return np.frombuffer(data, dtype="<f4").astype(np.float32), rate
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.kill()
+            self.worker.wait()
+            self.worker = None
+
+
+class FilterPlugins():
+    """
+    Loaded plugins and workers of a sound filter directory, keyed by file
+    name. A file is loaded again when it changes.
+    """
+
+    filters_path: str
+
+    def __init__(self, filters_path) -> None:
+        self.filters_path = filters_path
+        self.lock = threading.Lock()
+        # name -> (mtime of the file, plugin or None if it is not one)
+        self.plugins: dict[str, tuple[int, ModulePlugin | PipeWorker | None]] = {}
+
+    def path(self, name: str) -> str | None:
+        return filter_path(self.filters_path, name)
+
+    def get(self, name: str) -> ModulePlugin | PipeWorker | None:
+        path = self.path(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        mtime = os.stat(path).st_mtime_ns
+
+        with self.lock:
+            cached = self.plugins.get(name)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+            if cached is not None and cached[1] is not None:
+                cached[1].close()
+
+            plugin = None
+            try:
+                if name.endswith(".py") and defines_process(path):
+                    plugin = ModulePlugin(path)
+                elif supports_pcm_stream(path):
+                    plugin = PipeWorker(path)
+            except Exception as e:
+                print("WARNING: could not load filter plugin %s: %s" % (path, e))
+            self.plugins[name] = (mtime, plugin)
+            return plugin
+
+    def apply(self, name: str, samples, sample_rate: int):
+        """
+        Returns the filtered samples at sample_rate, or None if name is not
+        a plugin or failed, in which case it should be run as a script.
+        """
+        plugin = self.get(name)
+        if plugin is None:
+            return None
+        try:
+            result = plugin.process(samples, sample_rate)
+        except Exception as e:
+            print("WARNING: filter plugin %s failed: %s" % (name, e))
+            return None
+
+        rate = sample_rate
+        if isinstance(result, tuple):
+            result, rate = result
+        result = np.asarray(result, dtype=np.float32)
+        if result.ndim > 1:
+            result = result.mean(axis=1)
+        if rate != sample_rate:
+            result = dsp.resample(result, sample_rate / rate)
+        return result
+
+    def close(self):
+        with self.lock:
+            for _, plugin in self.plugins.values():
+                if plugin is not None:
+                    plugin.close()
+            self.plugins.clear()
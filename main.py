@@ -14,47 +14,111 @@ import click
 @click.option("--threads", default=2, help="Number of threads (CPU only)")
 @click.option("--stdin", is_flag=True, default=False, help="Read from standard input")
 @click.option("--outfile", default="audio.wav", help="Audio file to write to")
-def main(cpu, threads, stdin, outfile):
+@click.option("--batch-size", default=8,
+              help="Utterances per batched inference (0 to disable batching)")
+@click.option("--in-memory", is_flag=True, default=False,
+              help="Keep intermediate audio in memory instead of .buffer")
+@click.option("--precision", default="fp32",
+              type=click.Choice(["fp32", "int8", "bf16"]),
+              help="Inference precision (CPU only)")
+@click.option("--compile", "compile_mode", default="eager",
+              type=click.Choice(["eager", "torchscript", "inductor"]),
+              help="Compile HiFi-GAN and the Tacotron2 decoder")
+@click.option("--render-threads", default=4,
+              help="Threads for filters and effects (with --in-memory)")
+@click.option("--format", "audio_format", default=None,
+              type=click.Choice(["wav", "flac", "opus", "ogg", "mp3"]),
+              help="Output format (default: from the extension of --outfile)")
+@click.option("--batch", default=None,
+              help="Render a directory of .txt scripts or a JSONL manifest")
+@click.option("--outdir", default="out", help="Output directory (with --batch)")
+@click.option("--workers", default=1,
+              help="Worker processes, each with its own models (with --batch)")
+def main(cpu, threads, stdin, outfile, batch_size, in_memory, precision,
+         compile_mode, render_threads, audio_format, batch, outdir, workers):
+    if batch is not None:
+        sys.exit(0 if main_batch(cpu, threads, batch_size, precision,
+                                 compile_mode, render_threads, audio_format,
+                                 batch, outdir, workers) else 1)
+
+    import os
+    import soundfile as sf
+    import encoding
     import tokens
-    from tokens import Token, Group
+    from tokens import Token, Group, prerender, render_file, BUFFER_PATH
     from tokenizer import Tokenizer
+    from scheduler import Scheduler
     from bitcoin_miner import BitcoinMiner
 
-    bitcoin_miner = BitcoinMiner(not cpu, threads)
+    bitcoin_miner = BitcoinMiner(not cpu, threads, precision=precision,
+                                 compile_mode=compile_mode)
     bitcoin_miner.update_model("udisen")
     tokens.speech_synthesizer = bitcoin_miner
+    scheduler = Scheduler(render_threads) if in_memory else None
+    audio_format = audio_format or encoding.format_of(outfile)
+
+    try:
+        while True:
+            try:
+                # dash argument to read from stdin
+                if stdin:
+                    line = sys.stdin.read().replace("\n", " ")
+                else:
+                    print("-" * 50)
+                    line = input()
+                if line == "":
+                    continue
+                root = Group([])
+                Tokenizer(line, root).tokenize(root)
+                root.outfile = outfile
+                if in_memory:
+                    render_file(root, outfile, scheduler, batch_size, audio_format)
+                else:
+                    # synthesizes one speaker at a time
+                    prerender(root, batch_size)
+                    if audio_format != "wav":
+                        # sox writes wav, encode it afterwards
+                        root.outfile = os.path.join(BUFFER_PATH, "out.wav")
+                    if root.synthesize() and audio_format != "wav":
+                        samples, sample_rate = sf.read(root.outfile, dtype="float32")
+                        encoding.write(outfile, samples, sample_rate, audio_format)
+
+                if stdin:
+                    exit(0)
+                #if line.startswith("model:"):
+                #    words = line.split(" ")
+                #    speech = " ".join(words[1:])
+                #    speaker = words[0].split(":")[-1]
+                #    bitcoin_miner.update_model(speaker)
+                #    line = speech
+                #audio = bitcoin_miner.end_to_end_infer(line, None)
+                #if audio is not None:
+                #    sf.write("audio.wav", audio.to("cpu").numpy(), 22050)
+            except EOFError:
+                break
+            except KeyboardInterrupt:
+                print("Stopping...")
+                break
+    finally:
+        bitcoin_miner.close()
+
+def main_batch(cpu, threads, batch_size, precision, compile_mode,
+               render_threads, audio_format, batch, outdir, workers) -> bool:
+    # models are only loaded by the workers, always rendering in memory
+    from batch import render_batch
+    from synthesis_pool import SynthesisPool
 
-    while True:
-        try:
-            # dash argument to read from stdin
-            if stdin:
-                line = sys.stdin.read().replace("\n", " ")
-            else:
-                print("-" * 50)
-                line = input()
-            if line == "":
-                continue
-            root = Group([])
-            Tokenizer(line, root).tokenize(root)
-            root.outfile = outfile
-            root.synthesize()
-
-            if stdin:
-                exit(0)
-            #if line.startswith("model:"):
-            #    words = line.split(" ")
-            #    speech = " ".join(words[1:])
-            #    speaker = words[0].split(":")[-1]
-            #    bitcoin_miner.update_model(speaker)
-            #    line = speech
-            #audio = bitcoin_miner.end_to_end_infer(line, None)
-            #if audio is not None:
-            #    sf.write("audio.wav", audio.to("cpu").numpy(), 22050)
-        except EOFError:
-            break
-        except KeyboardInterrupt:
-            print("Stopping...")
-            break
+    pool = SynthesisPool(workers, "process", not cpu, threads, "udisen",
+                         batch_size, True, precision, render_threads,
+                         workers > 1, compile_mode)
+    try:
+        return render_batch(batch, outdir, pool, audio_format or "wav")
+    except KeyboardInterrupt:
+        print("Stopping...")
+        pool.shutdown(cancel=True)
+        return False
+    finally:
+        pool.shutdown()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,266 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+STEP_BUCKETS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000)
+LENGTH_BUCKETS = (10, 25, 50, 100, 200, 400, 800, 1600)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values, extra="") -> str:
+    pairs = ["%s=\"%s\"" % (name, escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric():
+    """
+    A named metric with a fixed set of label names. Values are kept per
+    combination of label values.
+    """
+
+    type = "untyped"
+    name: str
+    help: str
+    labels: tuple
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: dict[tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError("%s expects labels %s, got %s"
+                             % (self.name, self.labels, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def snapshot(self, reset=False) -> dict:
+        with self.lock:
+            values = {key: self.copy(value) for key, value in self.values.items()}
+            if reset:
+                self.values.clear()
+        return values
+
+    def copy(self, value):
+        return value
+
+    def merge(self, values: dict):
+        raise NotImplementedError()
+
+    def lines(self) -> list[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        header = ["# HELP %s %s" % (self.name, self.help),
+                  "# TYPE %s %s" % (self.name, self.type)]
+        return "\n".join(header + self.lines())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, values: dict):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    def lines(self) -> list[str]:
+        return ["%s%s %s" % (self.name, format_labels(self.labels, key),
+                             format_number(value))
+                for key, value in sorted(self.snapshot().items())]
+
+
+class Histogram(Metric):
+    """
+    Values are [count per bucket..., count above the last bucket, sum].
+    Bucket counts are stored per bucket and only made cumulative when
+    rendered.
+    """
+
+    type = "histogram"
+    buckets: tuple
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def copy(self, value):
+        return list(value)
+
+    def merge(self, values: dict):
+        with self.lock:
+            for key, counts in values.items():
+                mine = self.values.get(key)
+                if mine is None:
+                    self.values[key] = list(counts)
+                else:
+                    self.values[key] = [a + b for a, b in zip(mine, counts)]
+
+    def lines(self) -> list[str]:
+        lines = []
+        for key, counts in sorted(self.snapshot().items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "le=\"%s\"" % format_number(bound)
+                lines.append("%s_bucket%s %d" % (
+                    self.name, format_labels(self.labels, key, le), total))
+            labels = format_labels(self.labels, key)
+            lines.append("%s_sum%s %s" % (self.name, labels,
+                                          format_number(counts[-1])))
+            lines.append("%s_count%s %d" % (self.name, labels, total))
+        return lines
+
+
+class Registry():
+    """
+    Set of metrics rendered together in the Prometheus text format. Worker
+    processes send snapshot(reset=True) back with their results and the
+    server merges them into its own registry.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric \"%s\" is already registered" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def snapshot(self, reset=False) -> dict:
+        return {name: metric.snapshot(reset)
+                for name, metric in self.metrics.items()}
+
+    def merge(self, snapshot: dict):
+        for name, values in snapshot.items():
+            if name in self.metrics:
+                self.metrics[name].merge(values)
+
+    def render(self) -> str:
+        return "\n".join(metric.render()
+                         for metric in self.metrics.values()) + "\n"
+
+
+# label of speakers, filters and effects that do not exist, so that
+# arbitrary names from requests cannot add series
+OTHER = "other"
+
+REGISTRY = Registry()
+
+TOKEN_SECONDS = REGISTRY.histogram(
+    "bitcoin_miner_token_seconds",
+    "Time spent synthesizing a token, excluding its children",
+    ("kind", "name"))
+SPEECH_CHARACTERS = REGISTRY.histogram(
+    "bitcoin_miner_speech_characters",
+    "Length of the text of synthesized speech tokens",
+    ("speaker",), LENGTH_BUCKETS)
+MODEL_LOAD_SECONDS = REGISTRY.histogram(
+    "bitcoin_miner_model_load_seconds",
+    "Time spent loading a Tacotron2 model that was not cached",
+    ("speaker",))
+MODEL_SWITCHES = REGISTRY.counter(
+    "bitcoin_miner_model_switches_total",
+    "Number of times the current speaker changed",
+    ("speaker", "cached"))
+MODEL_PREFETCHES = REGISTRY.counter(
+    "bitcoin_miner_model_prefetches_total",
+    "Models of upcoming speakers loaded in the background, by result: ready "
+    "(loaded before it was needed), waited (still loading when needed) or "
+    "skipped (did not fit in the model cache)",
+    ("speaker", "result"))
+MODEL_LOAD_HIDDEN_SECONDS = REGISTRY.counter(
+    "bitcoin_miner_model_load_hidden_seconds_total",
+    "Model load time that overlapped with synthesis thanks to prefetching",
+    ("speaker",))
+MODEL_SWITCHES_AVOIDED = REGISTRY.counter(
+    "bitcoin_miner_model_switches_avoided_total",
+    "Speaker changes saved by synthesizing each speaker's speech together")
+DECODER_STEPS = REGISTRY.histogram(
+    "bitcoin_miner_decoder_steps",
+    "Tacotron2 decoder steps per utterance",
+    ("speaker",), STEP_BUCKETS)
+DECODER_STOPS = REGISTRY.counter(
+    "bitcoin_miner_decoder_stops_total",
+    "Utterances by why decoding stopped: gate, alignment (attention reached "
+    "the end of the input) or budget (overran its step budget)",
+    ("speaker", "reason"))
+DECODER_TRIMMED_FRAMES = REGISTRY.counter(
+    "bitcoin_miner_decoder_trimmed_frames_total",
+    "Frames of trailing silence that were not vocoded",
+    ("speaker",))
+HIFIGAN_SECONDS = REGISTRY.histogram(
+    "bitcoin_miner_hifigan_seconds",
+    "Time spent in one HiFi-GAN forward pass",
+    ("batch",))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "bitcoin_miner_request_seconds",
+    "Time to serve a synthesis request",
+    ("mode",))
+REQUESTS = REGISTRY.counter(
+    "bitcoin_miner_requests_total",
+    "Synthesis requests by outcome",
+    ("mode", "status"))
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    "bitcoin_miner_admission_rejections_total",
+    "Requests turned away by admission control, by response status",
+    ("status",))
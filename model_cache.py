@@ -0,0 +1,155 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from collections import OrderedDict
+from typing import Any
+import threading
+
+
+def tensors_size(value, seen: set) -> int:
+    # bytes of the tensors in value, which may be nested in the tuples and
+    # packed params (ScriptObjects) that quantized modules save
+    import torch
+    if isinstance(value, torch.Tensor):
+        key = (value.data_ptr(), value.numel(), value.dtype)
+        if key in seen:
+            return 0
+        seen.add(key)
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(tensors_size(item, seen) for item in value)
+    if isinstance(value, torch.ScriptObject):
+        try:
+            return tensors_size(value.__getstate__(), seen)
+        except Exception:
+            return 0
+    return 0
+
+
+def model_size(model) -> int:
+    """
+    Returns the number of bytes held by a module's parameters, buffers and
+    state_dict. Dynamically quantized layers keep their int8 weights packed
+    in the state_dict rather than as parameters.
+    """
+    seen = set()
+    size = tensors_size(list(model.parameters()) + list(model.buffers()), seen)
+    return size + tensors_size(list(model.state_dict().values()), seen)
+
+
+class ModelCache():
+    """
+    Bounded LRU cache of loaded models keyed by speaker name.
+
+    The cache is limited both by the number of entries (max_models) and by
+    the total size in bytes of the cached models (max_bytes, None for no
+    limit). Pinned entries are never evicted, nor is the entry just put,
+    even if it does not fit by itself. The cache may be used from several
+    threads, see prefetch.py.
+    """
+
+    max_models: int
+    max_bytes: int | None
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __init__(self, max_models=4, max_bytes=None) -> None:
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self.pinned: set[str] = set()
+        self.lock = threading.RLock()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def total_bytes(self) -> int:
+        with self.lock:
+            return sum(size for _, size in self.entries.values())
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key: str, value, size: int = 0, keep=()):
+        # keep: keys that may not be evicted to make room, like pinned ones
+        with self.lock:
+            self.entries[key] = (value, size)
+            self.entries.move_to_end(key)
+            self.evict({key, *keep})
+            if self.is_full():
+                print("WARNING: model cache is over its limit, keeping \"%s\" "
+                      "(%d bytes) anyway" % (key, size))
+
+    def fits(self, size: int, keep=()) -> bool:
+        # whether an entry of size bytes can be added without evicting
+        # pinned entries or entries in keep
+        with self.lock:
+            kept = [k for k in self.entries if k in self.pinned or k in keep]
+            if len(kept) + 1 > self.max_models:
+                return False
+            if self.max_bytes is not None:
+                kept_bytes = sum(self.entries[k][1] for k in kept)
+                return kept_bytes + size <= self.max_bytes
+            return True
+
+    def pin(self, key: str):
+        with self.lock:
+            self.pinned.add(key)
+
+    def unpin(self, key: str):
+        with self.lock:
+            self.pinned.discard(key)
+            self.evict()
+
+    def remove(self, key: str):
+        with self.lock:
+            self.pinned.discard(key)
+            self.entries.pop(key, None)
+
+    def is_full(self) -> bool:
+        if len(self.entries) > self.max_models:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def evict(self, keep=()):
+        # least recently used entries are at the start of the dict
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if not self.is_full():
+                    break
+                if key in self.pinned or key in keep:
+                    continue
+                del self.entries[key]
+                self.evictions += 1
+                print("INFO: evicted model \"%s\" from cache" % key)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "pinned": sorted(self.pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
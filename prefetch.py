@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+import threading
+import time
+
+import metrics
+from model_cache import model_size
+
+if TYPE_CHECKING:
+    from bitcoin_miner import BitcoinMiner
+
+
+class Prefetcher():
+    """
+    Loads the Tacotron2 models of upcoming speakers into a BitcoinMiner's
+    model cache on a background thread while the current speaker is being
+    synthesized, so that update_model finds them already loaded. A model is
+    only prefetched if it fits in the cache without evicting the current
+    model or another upcoming one.
+    """
+
+    synthesizer: BitcoinMiner
+    # total load time that overlapped with synthesis
+    hidden_seconds = 0.0
+
+    def __init__(self, synthesizer) -> None:
+        self.synthesizer = synthesizer
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1, "prefetch")
+        # speaker -> future of the seconds its load took, None if it was not
+        # loaded
+        self.loads: dict[str, Future] = {}
+        # speakers still to come, in order, from the last prefetch() call
+        self.upcoming: list[str] = []
+
+    def prefetch(self, speakers):
+        # speakers in the order they will be used, replaces the previous plan
+        synthesizer = self.synthesizer
+        upcoming = []
+        for speaker in speakers:
+            # unknown speakers are left to update_model to report
+            if (speaker != synthesizer.model_name and speaker not in upcoming
+                    and synthesizer.has_model(speaker)):
+                upcoming.append(speaker)
+
+        with self.lock:
+            self.upcoming = upcoming
+            for speaker in upcoming:
+                if speaker in synthesizer.models:
+                    continue
+                pending = self.loads.get(speaker)
+                if pending is not None and not pending.done():
+                    continue
+                self.loads[speaker] = self.executor.submit(self.load, speaker)
+
+    def load(self, speaker: str) -> float | None:
+        synthesizer = self.synthesizer
+        with self.lock:
+            if speaker not in self.upcoming:
+                # planned by an earlier request that is done by now
+                return None
+            keep = {synthesizer.model_name, *self.upcoming}
+        if speaker in synthesizer.models:
+            return None
+
+        # every speaker has the same architecture, so the current model
+        # tells how much room the next one needs
+        size = 0
+        if synthesizer.model is not None:
+            size = model_size(synthesizer.model)
+        if not synthesizer.models.fits(size, keep):
+            metrics.MODEL_PREFETCHES.inc(speaker=speaker, result="skipped")
+            return None
+
+        start = time.perf_counter()
+        try:
+            loaded = synthesizer.get_tacotron2("models/" + speaker)
+        except Exception:
+            # update_model loads it again and reports the error
+            return None
+        metrics.MODEL_LOAD_SECONDS.observe(time.perf_counter() - start,
+                                           speaker=speaker)
+        synthesizer.models.put(speaker, loaded, model_size(loaded[0]), keep)
+        return time.perf_counter() - start
+
+    def wait(self, speaker: str):
+        """
+        Called before switching to speaker. Blocks while its model is still
+        being prefetched, and records how much of the load was hidden.
+        """
+        with self.lock:
+            pending = self.loads.pop(speaker, None)
+        if pending is None:
+            return
+
+        ready = pending.done()
+        start = time.perf_counter()
+        load_seconds = pending.result()
+        waited = time.perf_counter() - start
+        if load_seconds is None:
+            return
+
+        hidden = max(0.0, load_seconds - waited)
+        self.hidden_seconds += hidden
+        metrics.MODEL_PREFETCHES.inc(speaker=speaker,
+                                     result="ready" if ready else "waited")
+        metrics.MODEL_LOAD_HIDDEN_SECONDS.inc(hidden, speaker=speaker)
+        print("INFO: prefetching hid %.2fs of %.2fs loading \"%s\""
+              % (hidden, load_seconds, speaker))
+
+    def planned(self) -> set[str]:
+        # speakers that are still to come
+        with self.lock:
+            return set(self.upcoming)
+
+    def switched(self, speaker: str):
+        # called after switching to speaker. The previous model may be
+        # evicted now, so speakers that did not fit before are tried again
+        with self.lock:
+            if speaker in self.upcoming:
+                del self.upcoming[:self.upcoming.index(speaker) + 1]
+            upcoming = list(self.upcoming)
+        if len(upcoming) > 0:
+            self.prefetch(upcoming)
+
+    def close(self):
+        with self.lock:
+            self.upcoming = []
+        self.executor.shutdown(cancel_futures=True)
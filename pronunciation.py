@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+import hashlib
+import os
+import struct
+import tempfile
+import numpy as np
+
+
+DICTIONARIES_PATH = "dictionaries"
+INDEX_PATH = ".cache/dictionaries"
+
+# magic, entry count, size and mtime of the source file
+HEADER = struct.Struct("<8sQQQ")
+MAGIC = b"BMPDICT2"
+
+
+def parse_dictionary(path: str) -> dict[str, str]:
+    """
+    Reads a CMUdict style file ("WORD  PH1 PH2 ..." per line). Comments
+    starting with ;;; and alternative pronunciations like WORD(1) are
+    skipped, the first pronunciation of a word wins.
+    """
+    entries: dict[str, str] = {}
+    with open(path, encoding="latin-1") as f:
+        for line in f:
+            if line.startswith(";;;"):
+                continue
+            parts = line.strip().split(" ", 1)
+            if len(parts) < 2 or parts[0].endswith(")"):
+                continue
+            entries.setdefault(parts[0].upper(), parts[1].strip())
+    return entries
+
+
+def word_hash(word: bytes) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(word, digest_size=8).digest(), "little")
+
+
+def compile_index(source: str, index: str):
+    """
+    Writes a memory-mappable index of a dictionary file, sorted by a 64-bit
+    hash of the word: header, hashes, key offsets, value offsets, key
+    bytes, value bytes.
+    """
+    entries = sorted((word_hash(key.encode()), key, value)
+                     for key, value in parse_dictionary(source).items())
+    hashes = np.array([h for h, _, _ in entries], dtype=np.uint64)
+    keys = [key.encode() for _, key, _ in entries]
+    values = [value.encode() for _, _, value in entries]
+    key_offsets = np.cumsum([0] + [len(k) for k in keys], dtype=np.uint64)
+    value_offsets = np.cumsum([0] + [len(v) for v in values], dtype=np.uint64)
+
+    stat = os.stat(source)
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    # workers compiling the same index at once each write their own file,
+    # whichever is renamed last wins and both are complete
+    fd, tmp = tempfile.mkstemp(".tmp", os.path.basename(index) + ".",
+                               os.path.dirname(index))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(entries), stat.st_size,
+                                stat.st_mtime_ns))
+            f.write(hashes.tobytes())
+            f.write(key_offsets.tobytes())
+            f.write(value_offsets.tobytes())
+            f.write(b"".join(keys))
+            f.write(b"".join(values))
+        os.replace(tmp, index)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class PronunciationIndex():
+    """
+    Read-only view of a compiled dictionary. The file is memory-mapped, so
+    opening it is cheap and worker processes share the same pages.
+    """
+
+    count: int
+
+    def __init__(self, index: str) -> None:
+        self.data = np.memmap(index, dtype=np.uint8, mode="r")
+        self.buffer = memoryview(self.data)
+        _, self.count, _, _ = HEADER.unpack_from(self.buffer)
+
+        start = HEADER.size
+        self.hashes = np.frombuffer(self.buffer, np.uint64, self.count, start)
+        start += self.count * 8
+        n = self.count + 1
+        self.key_offsets = np.frombuffer(self.buffer, np.uint64, n, start)
+        self.value_offsets = np.frombuffer(self.buffer, np.uint64, n, start + n * 8)
+        self.keys_start = start + 2 * n * 8
+        self.values_start = self.keys_start + int(self.key_offsets[-1])
+
+    @staticmethod
+    def is_current(source: str, index: str) -> bool:
+        if not os.path.exists(index):
+            return False
+        with open(index, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, _, size, mtime = HEADER.unpack(header)
+        stat = os.stat(source)
+        return magic == MAGIC and size == stat.st_size and mtime == stat.st_mtime_ns
+
+    def key(self, i: int) -> bytes:
+        start = self.keys_start + int(self.key_offsets[i])
+        end = self.keys_start + int(self.key_offsets[i + 1])
+        return bytes(self.buffer[start:end])
+
+    def value(self, i: int) -> str:
+        start = self.values_start + int(self.value_offsets[i])
+        end = self.values_start + int(self.value_offsets[i + 1])
+        return bytes(self.buffer[start:end]).decode()
+
+    def get(self, word: str) -> str | None:
+        target = word.encode()
+        h = word_hash(target)
+        i = int(self.hashes.searchsorted(np.uint64(h)))
+        # walk over colliding hashes
+        while i < self.count and int(self.hashes[i]) == h:
+            if self.key(i) == target:
+                return self.value(i)
+            i += 1
+        return None
+
+
+class PronunciationDictionary():
+    """
+    CMUdict (dictionaries/cmudict.txt) plus optional per-speaker overrides
+    (dictionaries/<speaker>.txt). Every file is compiled into an index
+    under .cache/dictionaries the first time it is used and whenever the
+    source changes.
+    """
+
+    dictionaries_path: str
+    index_path: str
+
+    def __init__(self, dictionaries_path=DICTIONARIES_PATH,
+                 index_path=INDEX_PATH) -> None:
+        self.dictionaries_path = dictionaries_path
+        self.index_path = index_path
+        self.indexes: dict[str, PronunciationIndex | None] = {}
+
+    def open(self, name: str) -> PronunciationIndex | None:
+        if name in self.indexes:
+            return self.indexes[name]
+
+        source = os.path.join(self.dictionaries_path, name + ".txt")
+        index = os.path.join(self.index_path, name + ".idx")
+        if not os.path.exists(source):
+            self.indexes[name] = None
+            return None
+        if not PronunciationIndex.is_current(source, index):
+            print("INFO: compiling pronunciation dictionary %s" % source)
+            compile_index(source, index)
+        self.indexes[name] = PronunciationIndex(index)
+        return self.indexes[name]
+
+    def lookup(self, word: str, speaker: str | None = None) -> str | None:
+        if speaker:
+            overrides = self.open(speaker)
+            if overrides is not None:
+                arpabet = overrides.get(word)
+                if arpabet is not None:
+                    return arpabet
+        base = self.open("cmudict")
+        if base is not None:
+            return base.get(word)
+        return None
+
+    def arpa(self, text: str, speaker: str | None = None,
+             punctuation=r"!?,.;", EOS_Token=True) -> str:
+        """
+        Replaces every known word with {ARPABET}, keeping trailing
+        punctuation outside the braces. Builds the output in a single pass
+        over the words.
+        """
+        parts: list[str] = []
+        for word in text.split(" "):
+            # strip trailing punctuation, but keep at least one character
+            stripped = word.rstrip(punctuation) or word[:1]
+            end_chars = word[len(stripped):]
+
+            arpabet = self.lookup(stripped.upper(), speaker)
+            if arpabet is not None:
+                stripped = "{" + arpabet + "}"
+
+            part = (stripped + end_chars).rstrip()
+            if len(parts) == 0:
+                part = part.lstrip()
+            if len(part) > 0:
+                parts.append(part)
+
+        out = " ".join(parts)
+        if EOS_Token and not out.endswith(";"):
+            out += ";"
+        return out
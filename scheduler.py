@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
+import tokens
+from tokens import (Token, Group, Speech, SoundFilter, plan_speeches,
+                    prerender_speaker)
+
+
+def chain(source: Future, target: Future):
+    # completes target with the outcome of source
+    def done(future: Future):
+        e = future.exception()
+        if e is not None:
+            target.set_exception(e)
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(done)
+
+
+def when_done(futures: list[Future], executor, function) -> Future:
+    """
+    Submits function(*results) to executor once every future in futures
+    has completed, and returns a future of its result. If any of futures
+    failed, the returned future fails with the same exception.
+    """
+    if len(futures) == 0:
+        return executor.submit(function)
+
+    result = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        for future in futures:
+            e = future.exception()
+            if e is not None:
+                result.set_exception(e)
+                return
+        try:
+            job = executor.submit(function, *[f.result() for f in futures])
+        except RuntimeError as e:
+            # the executor was shut down in the meantime
+            result.set_exception(e)
+            return
+        chain(job, result)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+
+class Scheduler():
+    """
+    Renders a token tree as a graph of jobs instead of depth first.
+
+    Speech runs on a single inference thread, since the synthesizer holds
+    the current model and Tacotron2/HiFi-GAN already use every torch thread.
+    It is synthesized in the order of plan_speeches(), grouped by speaker
+    so that each model is loaded once, not in tree order. Sound effects,
+    filters and group concatenation run on a thread pool as soon as their
+    inputs are ready, so they overlap with inference. The output is still
+    assembled in tree order, since groups always join their children in
+    tree order, so the result is the same as Token.render().
+    """
+
+    workers: int
+
+    def __init__(self, workers=4) -> None:
+        self.workers = workers
+        self.inference = ThreadPoolExecutor(1, "inference")
+        self.pool = ThreadPoolExecutor(workers, "render")
+
+    def render(self, root: Token, batch_size=0):
+        return self.submit(root, batch_size).result()
+
+    def submit(self, root: Token, batch_size=0) -> Future:
+        """
+        Returns a future of the rendered samples of root. Speech is
+        synthesized one speaker at a time (see plan_speeches), with one
+        batched job per speaker if batch_size > 0 and one job per token
+        otherwise.
+        """
+        # job that synthesizes the audio of each Speech
+        jobs: dict[Speech, Future] = {}
+        if any(True for _ in root.speeches()):
+            # the caller's synthesizer, the inference thread has none
+            synthesizer = tokens.current_synthesizer()
+            plan = plan_speeches(root, synthesizer.model_name)
+            synthesizer.prefetch([speaker for speaker, _ in plan])
+            for speaker, speeches in plan:
+                runs = [speeches] if batch_size > 0 else [[s] for s in speeches]
+                for run in runs:
+                    job = self.inference.submit(self.infer, synthesizer,
+                                                prerender_speaker, speaker,
+                                                run, batch_size)
+                    for speech in run:
+                        jobs[speech] = job
+        return self.compile(root, jobs)
+
+    def infer(self, synthesizer, function, *args):
+        tokens.use_synthesizer(synthesizer)
+        return function(*args)
+
+    def compile(self, token: Token, jobs: dict) -> Future:
+        if isinstance(token, Speech):
+            return when_done([jobs[token]], self.pool, lambda _: token.render())
+
+        if isinstance(token, SoundFilter):
+            child = self.compile(token.group, jobs)
+
+            def process(samples):
+                if samples is None:
+                    return None
+                return token.process(samples)
+            return when_done([child], self.pool, process)
+
+        if isinstance(token, Group):
+            children = [self.compile(child, jobs)
+                        for child in token.tokens]
+            return when_done(children, self.pool,
+                             lambda *buffers: token.concatenate(list(buffers)))
+
+        # sound effects, nothing to wait for
+        return self.pool.submit(token.render)
+
+    def shutdown(self):
+        self.inference.shutdown()
+        self.pool.shutdown()
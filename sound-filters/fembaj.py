@@ -5,16 +5,28 @@
 #
 # Distributed under terms of the GPLv3 license.
 
-# This is the python script version of the fembaj.sh filter
+# This is the python script version of the fembaj.sh filter. It is loaded
+# as a plugin (see filter_plugins.py), so process() runs in process on the
+# samples. Run directly, it still filters the file given as argument.
 
-import sox
-import sys
 
+def process(samples, sample_rate):
+    # only importable from the repository, not when run as a script
+    import dsp
 
-print("Input file: " + sys.argv[1])
-print("Output file: " + sys.argv[2])
+    samples = dsp.treble(samples, sample_rate, 4)
+    samples = dsp.bass(samples, sample_rate, -2)
+    return dsp.pitch(samples, sample_rate, 2)  # pitch in semitones
 
-tfm = sox.Transformer()
-tfm.treble(4).bass(-2).pitch(2)  # pitch in semitones
 
-tfm.build_file(sys.argv[1], sys.argv[2])
+if __name__ == "__main__":
+    import sys
+    import sox
+
+    print("Input file: " + sys.argv[1])
+    print("Output file: " + sys.argv[2])
+
+    tfm = sox.Transformer()
+    tfm.treble(4).bass(-2).pitch(2)  # pitch in semitones
+
+    tfm.build_file(sys.argv[1], sys.argv[2])
@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+import numpy as np
+
+
+class SynthesisCache():
+    """
+    Content-addressed cache of synthesized utterances. Entries are keyed by
+    a hash of everything that determines the audio (see key()) and kept in
+    an in-memory LRU tier backed by a size-capped directory of .npy files.
+    """
+
+    memory_items: int
+    disk_path: str | None
+    disk_bytes: int
+
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    def __init__(self, memory_items=256, disk_path=".cache/synthesis",
+                 disk_bytes=512 * 1024 * 1024) -> None:
+        self.memory_items = memory_items
+        self.disk_path = disk_path
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.disk_usage = 0
+
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+            for file in self.entries():
+                try:
+                    self.disk_usage += os.path.getsize(file)
+                except FileNotFoundError:
+                    continue
+
+    @staticmethod
+    def key(model_id: str, sequence, hparams, decoding="") -> str:
+        h = hashlib.sha256()
+        h.update(model_id.encode())
+        h.update(np.asarray(sequence, dtype=np.int64).tobytes())
+        h.update(("%r:%r:%s" % (hparams["gate_threshold"],
+                                hparams["max_decoder_steps"],
+                                decoding)).encode())
+        return h.hexdigest()
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.disk_path, key + ".npy")
+
+    def entries(self) -> list[str]:
+        # cached files, without other workers' writes in progress
+        return [os.path.join(self.disk_path, f)
+                for f in os.listdir(self.disk_path)
+                if f.endswith(".npy") and ".tmp" not in f]
+
+    def get(self, key: str) -> np.ndarray | None:
+        # returns a copy, filters may change the audio in place
+        with self.lock:
+            if key in self.memory:
+                self.memory_hits += 1
+                self.memory.move_to_end(key)
+                return self.memory[key].copy()
+
+            if self.disk_path is not None and os.path.exists(self.file(key)):
+                try:
+                    samples = np.load(self.file(key))
+                    # mtime is used as the access time for disk eviction
+                    os.utime(self.file(key))
+                except (OSError, ValueError):
+                    # evicted by another worker in the meantime
+                    samples = None
+                if samples is not None:
+                    self.disk_hits += 1
+                    self.remember(key, samples)
+                    return samples.copy()
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, samples: np.ndarray):
+        with self.lock:
+            # samples may share memory with audio that is still being used
+            self.remember(key, samples.copy())
+            if self.disk_path is not None and not os.path.exists(self.file(key)):
+                # the audio is already synthesized, failing to cache it
+                # must not fail the request
+                try:
+                    self.write(key, samples)
+                    self.trim_disk()
+                except OSError as e:
+                    print("WARNING: could not cache %s: %s" % (key, e))
+
+    def write(self, key: str, samples: np.ndarray):
+        # every writer has its own temporary file, workers sharing the
+        # directory may write the same key at the same time
+        fd, tmp = tempfile.mkstemp(".tmp", key + ".", self.disk_path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, samples)
+            os.replace(tmp, self.file(key))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        try:
+            self.disk_usage += os.path.getsize(self.file(key))
+        except FileNotFoundError:
+            # already evicted by another worker
+            pass
+
+    def remember(self, key: str, samples: np.ndarray):
+        self.memory[key] = samples
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def trim_disk(self):
+        if self.disk_usage <= self.disk_bytes:
+            return
+        files = []
+        for file in self.entries():
+            try:
+                files.append((os.path.getmtime(file), file))
+            except FileNotFoundError:
+                continue
+        files.sort()
+        for _, file in files:
+            if self.disk_usage <= self.disk_bytes:
+                break
+            try:
+                size = os.path.getsize(file)
+                os.remove(file)
+            except FileNotFoundError:
+                # removed by another worker sharing the directory
+                continue
+            self.disk_usage -= size
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        return {
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.disk_usage,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
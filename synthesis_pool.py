@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+# vim:fenc=utf-8
+#
+# Copyright © 2023 sandvich <sandvich@archtop>
+#
+# Distributed under terms of the GPLv3 license.
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import multiprocessing.util
+import os
+import queue
+import shutil
+import threading
+import uuid
+import soundfile as sf
+
+import metrics
+import tokens
+from tokens import Group, SAMPLE_RATE, BUFFER_PATH, prerender
+from tokenizer import Tokenizer
+from scheduler import Scheduler
+from encoding import encode, pcm16, wav_stream_header
+
+# the scheduler of each worker thread, see init_worker()
+workers = threading.local()
+# synthesizers created by init_worker() in this process, closed on shutdown
+synthesizers = []
+
+
+def init_worker(is_using_cuda, cpu_threads, default_model, precision,
+                render_threads=2, share_weights=False, compile_mode="eager"):
+    # runs once in every worker thread or process. torch is only imported
+    # here so that the server process itself starts quickly
+    from bitcoin_miner import BitcoinMiner
+    synthesizer = BitcoinMiner(is_using_cuda, cpu_threads, precision=precision,
+                               share_weights=share_weights,
+                               compile_mode=compile_mode)
+    synthesizers.append(synthesizer)
+    if multiprocessing.parent_process() is not None:
+        # worker processes are not told when the pool shuts down, this runs
+        # when the worker exits, before its threads are joined
+        multiprocessing.util.Finalize(synthesizer, synthesizer.close,
+                                      exitpriority=10)
+    synthesizer.update_model(default_model)
+    tokens.use_synthesizer(synthesizer)
+    workers.scheduler = Scheduler(render_threads)
+
+
+def collected(job, *args):
+    # runs job in a worker process and sends the metrics it recorded back
+    # along with the result, the server merges them into its registry
+    try:
+        return job(*args), metrics.REGISTRY.snapshot(reset=True)
+    except Exception as e:
+        e.metrics = metrics.REGISTRY.snapshot(reset=True)
+        raise
+
+
+def synthesize_job(text: str, batch_size: int, in_memory: bool,
+                   format="wav") -> bytes | None:
+    # every request gets its own buffer directory so that concurrent
+    # requests never write to the same files
+    buffer_path = os.path.join(BUFFER_PATH, uuid.uuid4().hex)
+    root = Group([])
+    Tokenizer(text, root).tokenize(root, buffer_path)
+
+    if in_memory:
+        samples = workers.scheduler.render(root, batch_size)
+        if samples is None:
+            return None
+        return encode(samples, SAMPLE_RATE, format)
+
+    prerender(root, batch_size)
+    os.makedirs(buffer_path)
+    try:
+        root.outfile = os.path.join(buffer_path, "out.wav")
+        if not root.synthesize():
+            return None
+        if format != "wav":
+            samples, sample_rate = sf.read(root.outfile, dtype="float32")
+            return encode(samples, sample_rate, format)
+        with open(root.outfile, "rb") as f:
+            return f.read()
+    finally:
+        shutil.rmtree(buffer_path, ignore_errors=True)
+
+
+def stream_job(text: str, chunks, collect_metrics=False, cancel=None):
+    # stops after the current chunk once cancel is set, so a client that
+    # went away does not keep its worker busy
+    stream = None
+    try:
+        if cancel is not None and cancel.is_set():
+            # the client left while the job was queued
+            return
+        root = Group([])
+        Tokenizer(text, root).tokenize(root)
+        # streamed in tree order, without regrouping by speaker
+        tokens.current_synthesizer().prefetch(
+            [speech.speaker for speech in root.speeches()])
+        chunks.put(wav_stream_header(SAMPLE_RATE))
+        stream = root.stream()
+        for samples in stream:
+            if cancel is not None and cancel.is_set():
+                break
+            chunks.put(pcm16(samples))
+    except Exception as e:
+        chunks.put(e)
+    finally:
+        if stream is not None:
+            # also stops the decoder thread of the current speech
+            stream.close()
+        if collect_metrics:
+            chunks.put(metrics.REGISTRY.snapshot(reset=True))
+        chunks.put(None)
+
+
+class Stream():
+    """
+    A streamed request on a SynthesisPool. Iterating yields the chunks of a
+    wav stream as the worker synthesizes them. close(), also called when
+    iteration stops early, tells the worker to stop after the current
+    chunk. on_done runs once the job is over, whether it finished, was
+    cancelled or never started.
+    """
+
+    def __init__(self, chunks, cancel, future: Future, on_done=None) -> None:
+        self.chunks = chunks
+        self.cancel = cancel
+        self.future = future
+        self.on_done = on_done
+        future.add_done_callback(self.done)
+
+    def done(self, future: Future):
+        if self.cancel.is_set():
+            self.drain()
+        if self.on_done is not None:
+            self.on_done()
+
+    def drain(self):
+        # nobody reads the rest, but keep the metrics of the worker
+        while True:
+            try:
+                chunk = self.chunks.get_nowait()
+            except (queue.Empty, OSError, EOFError):
+                return
+            if isinstance(chunk, dict):
+                metrics.REGISTRY.merge(chunk)
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if isinstance(chunk, dict):
+                    metrics.REGISTRY.merge(chunk)
+                    continue
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self.cancel.set()
+        if self.future.done():
+            self.drain()
+
+
+class SynthesisPool():
+    """
+    Pool of synthesis workers, each holding its own BitcoinMiner. Requests
+    are queued to whichever worker is free. mode is either "process" (one
+    miner per process, uses every core) or "thread" (shares the process,
+    useful on a single GPU). With share_weights, workers memory-map the
+    same exported weights, so memory grows with the number of speakers
+    loaded rather than with speakers times workers.
+    """
+
+    executor: Executor
+    mode: str
+    batch_size: int
+    in_memory: bool
+
+    def __init__(self, workers=1, mode="process", is_using_cuda=False,
+                 cpu_threads=1, default_model="udisen", batch_size=8,
+                 in_memory=True, precision="fp32", render_threads=2,
+                 share_weights=False, compile_mode="eager") -> None:
+        self.mode = mode
+        self.batch_size = batch_size
+        self.in_memory = in_memory
+        # started by the first streamed request in process mode
+        self.manager = None
+        self.manager_lock = threading.Lock()
+
+        initargs = (is_using_cuda, cpu_threads, default_model, precision,
+                    render_threads, share_weights, compile_mode)
+        if mode == "process":
+            # torch does not survive fork well, start clean interpreters
+            self.context = multiprocessing.get_context("spawn")
+            self.executor = ProcessPoolExecutor(workers, self.context,
+                                                init_worker, initargs)
+        elif mode == "thread":
+            self.executor = ThreadPoolExecutor(workers, "synthesis",
+                                               init_worker, initargs)
+        else:
+            raise ValueError("Unknown worker mode \"%s\"" % mode)
+
+    def submit(self, text: str, format="wav") -> Future:
+        # resolves to the audio file as bytes (see encoding.FORMATS), or
+        # None if nothing was synthesized
+        args = (text, self.batch_size, self.in_memory, format)
+        if self.mode != "process":
+            # threads already record into this process' registry
+            return self.executor.submit(synthesize_job, *args)
+
+        result = Future()
+
+        def done(future: Future):
+            e = future.exception()
+            if e is not None:
+                metrics.REGISTRY.merge(getattr(e, "metrics", {}))
+                result.set_exception(e)
+                return
+            audio, snapshot = future.result()
+            metrics.REGISTRY.merge(snapshot)
+            result.set_result(audio)
+
+        self.executor.submit(collected, synthesize_job, *args).add_done_callback(done)
+        return result
+
+    def stream(self, text: str, on_done=None) -> Stream:
+        # starts streaming text right away, see Stream
+        if self.mode == "process":
+            with self.manager_lock:
+                if self.manager is None:
+                    self.manager = self.context.Manager()
+            chunks = self.manager.Queue()
+            cancel = self.manager.Event()
+        else:
+            chunks = queue.Queue()
+            cancel = threading.Event()
+
+        future = self.executor.submit(stream_job, text, chunks,
+                                      self.mode == "process", cancel)
+        return Stream(chunks, cancel, future, on_done)
+
+    def shutdown(self, cancel=False):
+        # cancel drops requests that have not started yet
+        self.executor.shutdown(cancel_futures=cancel)
+        if self.mode == "thread":
+            for synthesizer in synthesizers:
+                synthesizer.close()
+        with self.manager_lock:
+            if self.manager is not None:
+                self.manager.shutdown()
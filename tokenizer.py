@@ -5,36 +5,39 @@
 #
 # Distributed under terms of the GPLv3 license.
 
-from tokens import Token, Group, Speech, SoundEffect, SoundFilter
+from tokens import Token, Group, Speech, SoundEffect, SoundFilter, BUFFER_PATH
 import re
 
 
+# one match per token: the speech before the next special character, then
+# either a speaker change, a {filter}, an [effect], an unclosed bracket or
+# the end of the input
+TOKEN_RE = re.compile(r"""
+    (?P<text>[^:{\[]*)
+    (?:
+        (?P<colon>:)
+      | \{(?P<filter>[^}]*)\}
+      | \[(?P<effect>[^\]]*)\]
+      | (?P<unclosed>[{\[])
+      | \Z
+    )""", re.VERBOSE)
+
+
 class Tokenizer:
     input_str: str
-    index: int
 
     current_text: str
     current_speaker: str = "udisen"
 
     def __init__(self, input_str: str, root: Group) -> None:
         self.input_str = input_str
-        self.index = -1
         self.context = root
 
-    def get_next(self) -> str | None:
-        if self.index < len(self.input_str) - 1:
-            return self.input_str[self.index + 1]
-
-    def move_next(self):
-        next = self.get_next()
-        self.index += 1
-        return next
-
-    def tokenize(self, root: Group):
+    def tokenize(self, root: Group, buffer_path=BUFFER_PATH):
         tokens = self.lex()
         self.parse(list(tokens), root)
         root.validate()
-        root.gen_file_name(0)
+        root.gen_file_name(0, buffer_path)
         return root
 
     def parse(self, tokens: list[Token], root: Group):
@@ -56,59 +59,40 @@ class Tokenizer:
             group.tokens.append(token)
         return root
 
-    def scan_to_delimiter(self, delimiter) -> str | None:
-        ret = ""
-        while self.get_next() != delimiter:
-            c = self.move_next()
-            if c is None:
-                return None
-            ret += c
-
-        self.move_next()
-
-        if len(ret) > 0:
-            #filter = SoundFilter()
-            #filter.index = filter_str
-            return ret
-
     def lex(self):
-        text = ""
+        pos = 0
         while True:
-            #input_string = ""
-            c = self.move_next()
-
-            if c is None:
-                # yield remaining text as speech
-                yield Speech(self.current_speaker, text)
-                return
-
-            if c in ":":
-                tokens = re.split(" |\\n", text)
-                previous_speech = " ".join(tokens[0:-1])
+            match = TOKEN_RE.match(self.input_str, pos)
+            text = match.group("text")
+            pos = match.end()
+
+            if match.group("colon") is not None:
+                # the last word before the colon is the new speaker
+                split = max(text.rfind(" "), text.rfind("\n"))
+                previous_speech = text[:split].replace("\n", " ") if split >= 0 else ""
                 yield Speech(self.current_speaker, previous_speech)
-                self.current_speaker = tokens[-1]
-                text = ""
-            elif c in "{":
+                self.current_speaker = text[split + 1:]
+            elif match.group("filter") is not None:
                 yield Speech(self.current_speaker, text)
-                text = ""
-
-                index = self.scan_to_delimiter("}")
-                if index:
+                if len(match.group("filter")) > 0:
                     filter = SoundFilter()
-                    filter.index = index
+                    filter.index = match.group("filter")
                     yield filter
-            elif c in "[":
+            elif match.group("effect") is not None:
                 yield Speech(self.current_speaker, text)
-                text = ""
-
-                index = self.scan_to_delimiter("]")
-                if index:
-                    filter = SoundEffect()
+                if len(match.group("effect")) > 0:
                     try:
-                        filter.index = int(index)
+                        filter = SoundEffect()
+                        filter.index = int(match.group("effect"))
                         yield filter
                     except ValueError:
                         continue
+            elif match.group("unclosed") is not None:
+                # an unclosed {filter or [effect swallows the rest of the input
+                yield Speech(self.current_speaker, text)
+                yield Speech(self.current_speaker, "")
+                return
             else:
-                text += c
-            #context.append_token(self.scan_text())
+                # yield remaining text as speech
+                yield Speech(self.current_speaker, text)
+                return
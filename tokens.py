@@ -5,22 +5,75 @@
 #
 # Distributed under terms of the GPLv3 license.
 
-from bitcoin_miner import BitcoinMiner
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import dsp
+import encoding
+import metrics
+from effect_bank import EffectBank
+from filter_plugins import FilterPlugins
+import numpy as np
 import soundfile as sf
 import sox
 import os
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
+
+if TYPE_CHECKING:
+    # importing torch is slow, tokens only needs the type
+    from bitcoin_miner import BitcoinMiner
 
 
 BUFFER_PATH = ".buffer"
 EFFECTS_PATH = "sound-effects"
 FILTERS_PATH = "sound-filters"
+SAMPLE_RATE = 22050
 
 if not os.path.exists(BUFFER_PATH):
     os.makedirs(BUFFER_PATH)
 
 speech_synthesizer: BitcoinMiner
+# per-thread synthesizers for worker pools, see use_synthesizer()
+synthesizers = threading.local()
+effect_bank = EffectBank(EFFECTS_PATH, sample_rate=SAMPLE_RATE)
+filter_plugins = FilterPlugins(FILTERS_PATH)
+
+
+def use_synthesizer(synthesizer: BitcoinMiner):
+    # overrides speech_synthesizer for the calling thread only
+    synthesizers.current = synthesizer
+
+
+def current_synthesizer() -> BitcoinMiner:
+    return getattr(synthesizers, "current", None) or speech_synthesizer
+
+
+def speaker_label(speaker: str) -> str:
+    # metric label of a speaker, OTHER unless it names a model
+    if current_synthesizer().has_model(speaker):
+        return speaker
+    return metrics.OTHER
+
+
+def filter_label(index: str) -> str:
+    # metric label of a filter, OTHER unless it is built in or a plugin
+    if index in dsp.FILTERS or filter_plugins.get(index) is not None:
+        return index
+    return metrics.OTHER
+
+
+def to_samples(audio) -> np.ndarray:
+    # converts decoded or synthesized audio to mono float32 samples
+    if not isinstance(audio, np.ndarray):
+        audio = audio.to("cpu").numpy()
+    if np.issubdtype(audio.dtype, np.integer):
+        audio = audio / np.iinfo(audio.dtype).max
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    return audio.astype(np.float32, copy=False)
 
 
 class Token:
@@ -29,16 +82,31 @@ class Token:
     def synthesize(self):
         raise NotImplementedError()
 
+    def render(self) -> np.ndarray | None:
+        # in-memory counterpart of synthesize, returns the samples instead
+        # of writing them to self.outfile
+        raise NotImplementedError()
+
+    def stream(self):
+        # yields the samples of the token piece by piece as they are done
+        samples = self.render()
+        if samples is not None:
+            yield samples
+
     def __str__(self) -> str:
         return "Token()"
 
     def validate(self):
         return self
 
-    def gen_file_name(self, id: int):
-        self.outfile = "%s/%03d.wav" % (BUFFER_PATH, id)
+    def gen_file_name(self, id: int, buffer_path=BUFFER_PATH):
+        self.outfile = "%s/%03d.wav" % (buffer_path, id)
         return id + 1
 
+    def speeches(self):
+        # yields every Speech leaf of the tree in synthesis order
+        return iter(())
+
 
 class Group(Token):
     tokens: list[Token]
@@ -59,16 +127,41 @@ class Group(Token):
 
         print("Synthesizing group: " + ", ".join(filenames))
 
-        if len(filenames) > 1:
-            combiner.build(filenames, self.outfile, "concatenate")
-        elif len(filenames) == 1:
-            shutil.copy(filenames[0], self.outfile)
-        else:
-            raise Exception("when nub write code, das a bing problem")
-            # ???
-            return False
+        with metrics.TOKEN_SECONDS.time(kind="group", name=""):
+            if len(filenames) > 1:
+                combiner.build(filenames, self.outfile, "concatenate")
+            elif len(filenames) == 1:
+                shutil.copy(filenames[0], self.outfile)
+            else:
+                raise Exception("when nub write code, das a bing problem")
+                # ???
+                return False
         return True
 
+    def render(self):
+        return self.concatenate([token.render() for token in self.tokens])
+
+    def concatenate(self, buffers: list) -> np.ndarray | None:
+        # joins the rendered children, skipping the ones that rendered None
+        buffers = [samples for samples in buffers if samples is not None]
+        if len(buffers) == 0:
+            return None
+        if len(buffers) == 1:
+            return buffers[0]
+
+        # assemble into one preallocated buffer
+        with metrics.TOKEN_SECONDS.time(kind="group", name=""):
+            out = np.empty(sum(len(b) for b in buffers), dtype=np.float32)
+            offset = 0
+            for samples in buffers:
+                out[offset:offset + len(samples)] = samples
+                offset += len(samples)
+        return out
+
+    def stream(self):
+        for token in self.tokens:
+            yield from token.stream()
+
     def __str__(self) -> str:
         tokens_str: list[str] = []
         for token in self.tokens:
@@ -88,15 +181,19 @@ class Group(Token):
             # dissolve group to reduce overhead during synthesis
             return self.tokens[0]
 
-    def gen_file_name(self, id: int):
+    def gen_file_name(self, id: int, buffer_path=BUFFER_PATH):
         # traverse tree
-        self.outfile = "%s/%03d.wav" % (BUFFER_PATH, id)
+        self.outfile = "%s/%03d.wav" % (buffer_path, id)
         id += 1
         for token in self.tokens:
-            id = token.gen_file_name(id)
+            id = token.gen_file_name(id, buffer_path)
         return id
         #return super().gen_file_name(id)
 
+    def speeches(self):
+        for token in self.tokens:
+            yield from token.speeches()
+
 
 class Sound(Token):
     pass
@@ -107,19 +204,62 @@ class Speech(Sound):
     text: str
     #synthesizer: BitcoinMiner
 
+    # audio already synthesized by prerender()
+    audio = None
+
     def __init__(self, speaker, text) -> None:
         self.speaker = speaker
         self.text = text
 
     def synthesize(self) -> bool:
-        speech_synthesizer.update_model(self.speaker)
-        print("Synthesizing %s speaking: %s" % (self.speaker, self.text))
-        audio = speech_synthesizer.end_to_end_infer(self.text, None)
+        if self.audio is not None:
+            audio = self.audio
+        else:
+            audio = self.infer()
         if audio is not None:
-            sf.write(self.outfile, audio.to("cpu").numpy(), 22050)
+            sf.write(self.outfile, audio.to("cpu").numpy(), SAMPLE_RATE)
             return True
         return False
 
+    def infer(self):
+        synthesizer = current_synthesizer()
+        print("Synthesizing %s speaking: %s" % (self.speaker, self.text))
+        label = speaker_label(self.speaker)
+        metrics.SPEECH_CHARACTERS.observe(len(self.text), speaker=label)
+        with metrics.TOKEN_SECONDS.time(kind="speech", name=label):
+            synthesizer.update_model(self.speaker)
+            return synthesizer.end_to_end_infer(self.text, None)
+
+    def render(self):
+        if self.audio is not None:
+            return to_samples(self.audio)
+        audio = self.infer()
+        if audio is not None:
+            return to_samples(audio)
+
+    def stream(self):
+        if self.audio is not None:
+            yield to_samples(self.audio)
+            return
+        synthesizer = current_synthesizer()
+        print("Synthesizing %s speaking: %s" % (self.speaker, self.text))
+        label = speaker_label(self.speaker)
+        metrics.SPEECH_CHARACTERS.observe(len(self.text), speaker=label)
+
+        # only count the time spent synthesizing, not the time the
+        # consumer holds on to each chunk
+        start = time.perf_counter()
+        synthesizer.update_model(self.speaker)
+        elapsed = 0.0
+        # one chunk per sentence
+        for audio in synthesizer.stream_infer(self.text, None):
+            samples = to_samples(audio)
+            elapsed += time.perf_counter() - start
+            yield samples
+            start = time.perf_counter()
+        elapsed += time.perf_counter() - start
+        metrics.TOKEN_SECONDS.observe(elapsed, kind="speech", name=label)
+
     def __str__(self) -> str:
         return "Speech(%s, %s)" % (self.speaker, self.text)
 
@@ -128,6 +268,9 @@ class Speech(Sound):
         if len(self.text) > 0:
             return self
 
+    def speeches(self):
+        yield self
+
 
 class SoundEffect(Sound):
     index: str
@@ -135,24 +278,25 @@ class SoundEffect(Sound):
     def synthesize(self):
         print("Synthesizing sound effect %s" % self.index)
 
-        audio_file = None
-        mp3_file = f"{EFFECTS_PATH}/{self.index}.mp3"
-        wav_file = f"{EFFECTS_PATH}/{self.index}.wav"
-        if os.path.exists(mp3_file):
-            audio_file = mp3_file
-        elif os.path.exists(wav_file):
-            audio_file = wav_file
-
-        if audio_file is None:
+        samples = self.load()
+        if samples is None:
             return False
 
-        (sox
-         .Transformer()
-         .convert(samplerate=22050)
-         .build_file(audio_file, self.outfile))
-
+        sf.write(self.outfile, samples, SAMPLE_RATE)
         return True
 
+    def render(self):
+        print("Synthesizing sound effect %s" % self.index)
+        return self.load()
+
+    def load(self):
+        start = time.perf_counter()
+        samples = effect_bank.get(self.index)
+        label = self.index if samples is not None else metrics.OTHER
+        metrics.TOKEN_SECONDS.observe(time.perf_counter() - start,
+                                      kind="effect", name=label)
+        return samples
+
     def __str__(self) -> str:
         return "SoundEffect(%d)" % self.index
 
@@ -165,17 +309,29 @@ class SoundFilter(Token):
             return False
 
         print("Synthesizing filter %s" % self.index)
+        with metrics.TOKEN_SECONDS.time(kind="filter",
+                                        name=filter_label(self.index)):
+            return self.apply_file()
 
-        tfm = sox.Transformer()
-
+    def apply_file(self):
+        # filters self.group.outfile into self.outfile
         def err(message):
             print("Failed synthesizing filter. Synthesizing without filter.")
             shutil.copy(self.group.outfile, self.outfile)
             return True
 
-        if os.path.exists(f"{FILTERS_PATH}/{self.index}"):
+        if filter_plugins.get(self.index) is not None:
+            samples, sample_rate = sf.read(self.group.outfile, dtype="float32")
+            filtered = filter_plugins.apply(self.index, to_samples(samples),
+                                            sample_rate)
+            if filtered is not None:
+                sf.write(self.outfile, filtered, sample_rate)
+                return True
+
+        script = filter_plugins.path(self.index)
+        if script is not None and os.path.exists(script):
             try:
-                return_code = subprocess.call([f"{FILTERS_PATH}/{self.index}",
+                return_code = subprocess.call([script,
                                  self.group.outfile,
                                  self.outfile])
                 if return_code != 0:
@@ -185,53 +341,61 @@ class SoundFilter(Token):
                 return err(f"Permission denied while processing {self.index}. " +
                            "Does the file have execute (+x) permission?")
             except FileNotFoundError:
-                return err(f"{FILTERS_PATH}/{self.index} does not exist.")
-
-        if self.index == "1":
-            # room echo
-            tfm.reverb(50, room_scale=25)
-        elif self.index == "2":
-            # hall echo
-            tfm.reverb(75, room_scale=75, wet_gain=1)
-        elif self.index == "3":
-            # outside echo
-            tfm.reverb(5, room_scale=5)
-        elif self.index == "4":
-            # pitch down
-            tfm.pitch(-6)  # half an octave
-        elif self.index == "5":
-            # pitch up
-            tfm.pitch(6)  # half an octave
-        elif self.index == "6":
-            # telephone
-            tfm.highpass(800).gain(2)
-        elif self.index == "7":
-            # muffled
-            tfm.lowpass(1200).gain(1)
-        elif self.index == "8":
-            # quieter
-            tfm.gain(-4)
-        elif self.index == "9":
-            # ghost
-            (tfm
-             .pad(0.5, 0.5)
-             .reverse()
-             .reverb(reverberance=50, wet_gain=1)
-             .reverse()
-             .reverb())
-        elif self.index == "10":
-            # chorus
-            tfm.chorus()
-        elif self.index == "11":
-            # slow down
-            tfm.tempo(0.5)
-        elif self.index == "12":
-            # speed up
-            tfm.tempo(1.5)
-
-        tfm.build_file(self.group.outfile, self.outfile)
+                return err(f"{script} does not exist.")
+
+        if self.index not in dsp.FILTERS:
+            shutil.copy(self.group.outfile, self.outfile)
+            return True
+
+        samples, sample_rate = sf.read(self.group.outfile, dtype="float32")
+        samples = dsp.apply_filter(self.index, to_samples(samples), sample_rate)
+        sf.write(self.outfile, samples, sample_rate)
         return True
 
+    def render(self):
+        samples = self.group.render()
+        if samples is None:
+            return None
+        return self.process(samples)
+
+    def process(self, samples):
+        # filters the already rendered samples of self.group
+        print("Synthesizing filter %s" % self.index)
+        with metrics.TOKEN_SECONDS.time(kind="filter",
+                                        name=filter_label(self.index)):
+            return self.apply(samples)
+
+    def apply(self, samples):
+        # returns the filtered samples, or samples if filtering failed
+        filtered = filter_plugins.apply(self.index, samples, SAMPLE_RATE)
+        if filtered is not None:
+            return filtered
+
+        script = filter_plugins.path(self.index)
+        if script is not None and os.path.exists(script):
+            # external scripts only understand files
+            with tempfile.TemporaryDirectory() as tmp:
+                infile = os.path.join(tmp, "in.wav")
+                outfile = os.path.join(tmp, "out.wav")
+                sf.write(infile, samples, SAMPLE_RATE)
+                try:
+                    return_code = subprocess.call([script, infile, outfile])
+                except (PermissionError, FileNotFoundError):
+                    return_code = -1
+                if return_code != 0:
+                    print("Failed synthesizing filter. Synthesizing without filter.")
+                    return samples
+                filtered, sample_rate = sf.read(outfile, dtype="float32")
+                filtered = to_samples(filtered)
+                if sample_rate != SAMPLE_RATE:
+                    filtered = dsp.resample(filtered, SAMPLE_RATE / sample_rate)
+                return filtered
+
+        filtered = dsp.apply_filter(self.index, samples, SAMPLE_RATE)
+        if filtered is None:
+            return samples
+        return filtered
+
     def __str__(self) -> str:
         if self.group is not None:
             return "SoundFilter(%s, \n%s\n)" % (self.index, self.group)
@@ -243,7 +407,98 @@ class SoundFilter(Token):
             self.group = group
             return self
 
-    def gen_file_name(self, id: int):
+    def gen_file_name(self, id: int, buffer_path=BUFFER_PATH):
         # traverse tree
-        self.outfile = "%s/%03d.wav" % (BUFFER_PATH, id)
-        return self.group.gen_file_name(id + 1)
+        self.outfile = "%s/%03d.wav" % (buffer_path, id)
+        return self.group.gen_file_name(id + 1, buffer_path)
+
+    def speeches(self):
+        return self.group.speeches()
+
+
+def render_file(root: Token, outfile: str, scheduler=None,
+                batch_size=0, format=None) -> bool:
+    """
+    Renders the whole tree in memory and only encodes the final result,
+    instead of writing every node to BUFFER_PATH. With a Scheduler, filters
+    and effects are rendered concurrently with speech synthesis. format is
+    one of encoding.FORMATS, by default the extension of outfile.
+    """
+    if scheduler is not None:
+        samples = scheduler.render(root, batch_size)
+    else:
+        samples = root.render()
+    if samples is None:
+        return False
+    encoding.write(outfile, samples, SAMPLE_RATE, format)
+    return True
+
+
+def prerender(root: Token, batch_size=8):
+    """
+    Synthesizes every Speech leaf of the tree ahead of time, one speaker at
+    a time, batching utterances unless batch_size is 0. Speech.synthesize
+    and Speech.render then only have to use the audio.
+    """
+    synthesizer = current_synthesizer()
+    plan = plan_speeches(root, synthesizer.model_name)
+    synthesizer.prefetch([speaker for speaker, _ in plan])
+    for speaker, speeches in plan:
+        prerender_speaker(speaker, speeches, batch_size)
+
+
+def speeches_by_speaker(root: Token) -> dict[str, list[Speech]]:
+    by_speaker: dict[str, list[Speech]] = {}
+    for speech in root.speeches():
+        by_speaker.setdefault(speech.speaker, []).append(speech)
+    return by_speaker
+
+
+def count_switches(speakers: list[str], current: str | None) -> int:
+    # number of update_model calls that change the model
+    switches = 0
+    for speaker in speakers:
+        if speaker != current:
+            switches += 1
+            current = speaker
+    return switches
+
+
+def plan_speeches(root: Token, current: str | None = None):
+    """
+    Orders the Speech leaves of root so that all of a speaker's speech is
+    synthesized in one run, starting with current (the loaded model) and
+    then in order of first appearance. Returns [(speaker, speeches)]. The
+    audio is still assembled in tree order, only synthesis is reordered.
+    """
+    by_speaker = speeches_by_speaker(root)
+    # sorted() is stable, so this only moves current to the front
+    runs = sorted(by_speaker.items(), key=lambda run: run[0] != current)
+
+    in_order = count_switches([s.speaker for s in root.speeches()], current)
+    planned = count_switches([speaker for speaker, _ in runs], current)
+    if in_order > planned:
+        print("INFO: grouping speakers avoided %d of %d model switches"
+              % (in_order - planned, in_order))
+        metrics.MODEL_SWITCHES_AVOIDED.inc(in_order - planned)
+    return runs
+
+
+def prerender_speaker(speaker: str, speeches: list[Speech], batch_size=8):
+    if batch_size <= 0:
+        # one utterance at a time, like Speech.render
+        for speech in speeches:
+            speech.audio = speech.infer()
+        return
+
+    synthesizer = current_synthesizer()
+    synthesizer.update_model(speaker)
+    print("Synthesizing %d utterances of %s" % (len(speeches), speaker))
+    # update_model succeeded, so speaker names a model
+    for speech in speeches:
+        metrics.SPEECH_CHARACTERS.observe(len(speech.text), speaker=speaker)
+    with metrics.TOKEN_SECONDS.time(kind="batch", name=speaker):
+        audios = synthesizer.batch_infer(
+            [speech.text for speech in speeches], None, batch_size)
+    for speech, audio in zip(speeches, audios):
+        speech.audio = audio
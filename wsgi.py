@@ -6,18 +6,49 @@
 # Distributed under terms of the GPLv3 license.
 
 
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file, stream_with_context
+import io
+import os
+import metrics
 import tokens
+from admission import AdmissionController, Rejected
+from encoding import ACCEPT_TYPES, FORMATS
+from synthesis_pool import Stream, SynthesisPool
 from tokens import Group
 from tokenizer import Tokenizer
-from bitcoin_miner import BitcoinMiner
 
 
 app = Flask(__name__)
 
-bitcoin_miner = BitcoinMiner(False, 4)
-bitcoin_miner.update_model("udisen")
-tokens.speech_synthesizer = bitcoin_miner
+BATCH_SIZE = 8
+# render intermediate audio in memory instead of through .buffer files
+IN_MEMORY = True
+# number of synthesis workers and whether they are processes or threads
+WORKERS = int(os.environ.get("BITCOIN_MINER_WORKERS", "2"))
+WORKER_MODE = os.environ.get("BITCOIN_MINER_WORKER_MODE", "process")
+CPU_THREADS = int(os.environ.get("BITCOIN_MINER_THREADS", "4"))
+PRECISION = os.environ.get("BITCOIN_MINER_PRECISION", "fp32")
+# "eager", "torchscript" or "inductor", see BitcoinMiner.compile_tacotron2
+COMPILE_MODE = os.environ.get("BITCOIN_MINER_COMPILE", "eager")
+# threads per worker for filters and effects, which overlap with inference
+RENDER_THREADS = int(os.environ.get("BITCOIN_MINER_RENDER_THREADS", "2"))
+# workers memory-map one shared copy of the model weights
+SHARE_WEIGHTS = os.environ.get("BITCOIN_MINER_SHARE_WEIGHTS", "1") == "1"
+# unfinished requests and their total estimated seconds of synthesis that
+# are accepted before new requests get 503, and the share of that a single
+# client may use before it gets 429
+MAX_QUEUE = int(os.environ.get("BITCOIN_MINER_MAX_QUEUE", str(WORKERS * 4)))
+MAX_COST = float(os.environ.get("BITCOIN_MINER_MAX_COST", str(WORKERS * 60)))
+CLIENT_SHARE = float(os.environ.get("BITCOIN_MINER_CLIENT_SHARE", "0.5"))
+MAX_BODY = int(os.environ.get("BITCOIN_MINER_MAX_BODY", "65536"))
+
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY
+
+tokens.effect_bank.preload()
+pool = SynthesisPool(WORKERS, WORKER_MODE, False, CPU_THREADS, "udisen",
+                     BATCH_SIZE, IN_MEMORY, PRECISION, RENDER_THREADS,
+                     SHARE_WEIGHTS, COMPILE_MODE)
+admission = AdmissionController(MAX_QUEUE, MAX_COST, CLIENT_SHARE, WORKERS)
 
 @app.route("/")
 def root_path():
@@ -29,16 +60,74 @@ def request_synthesis():
     if content is None:
         return "Bad request", 400
 
-    outfile = synthesize(content)
-    if outfile is None:
-        return 500
-
-    return send_file(outfile, mimetype="audio/wav")
+    # streams are always wav, the only format that is written chunk by
+    # chunk here
+    streaming = bool(request.args.get("stream"))
+    types = [t for t in ACCEPT_TYPES
+             if not streaming or ACCEPT_TYPES[t] == "wav"]
+    format = negotiate_format(types)
+    if format is None:
+        return "Supported types: " + ", ".join(types), 406
 
-def synthesize(text: str) -> str | None:
+    # tokenizing is cheap compared to synthesis, the tree is only used to
+    # estimate the cost of the request
     root = Group([])
-    Tokenizer(text, root).tokenize(root)
-    root.outfile = "audio.wav"
-    if root.synthesize():
-        return root.outfile
-    return None
+    Tokenizer(content, root).tokenize(root)
+    try:
+        ticket = admission.admit(request.remote_addr or "", root)
+    except Rejected as e:
+        return str(e), e.status, {"Retry-After": str(e.retry_after)}
+
+    if streaming:
+        # send each token as soon as it is synthesized. The ticket is
+        # released once the worker has stopped, not when the client goes
+        # away, so admission still counts a cancelled stream until its
+        # current chunk is done
+        stream = pool.stream(content, lambda: admission.release(ticket))
+        response = Response(stream_with_context(timed_stream(stream)),
+                            mimetype="audio/wav")
+        # also runs if the client goes away before the stream starts
+        response.call_on_close(stream.close)
+        return response
+
+    with metrics.REQUEST_SECONDS.time(mode="file"):
+        try:
+            audio = synthesize(content, format)
+        except Exception:
+            metrics.REQUESTS.inc(mode="file", status="error")
+            raise
+        finally:
+            admission.release(ticket)
+    if audio is None:
+        metrics.REQUESTS.inc(mode="file", status="empty")
+        return "Nothing was synthesized", 500
+
+    metrics.REQUESTS.inc(mode="file", status="ok")
+    return send_file(io.BytesIO(audio), mimetype=FORMATS[format].mimetype)
+
+def negotiate_format(types) -> str | None:
+    # picks one of types, a subset of ACCEPT_TYPES. No Accept header and
+    # */* get wav, the first of ACCEPT_TYPES
+    if not request.accept_mimetypes:
+        return "wav"
+    accepted = request.accept_mimetypes.best_match(types)
+    if accepted is None:
+        return None
+    return ACCEPT_TYPES[accepted]
+
+@app.route("/metrics")
+def metrics_path():
+    return Response(metrics.REGISTRY.render(),
+                    mimetype="text/plain; version=0.0.4")
+
+def timed_stream(stream: Stream):
+    status = "error"
+    try:
+        with metrics.REQUEST_SECONDS.time(mode="stream"):
+            yield from stream
+        status = "ok"
+    finally:
+        metrics.REQUESTS.inc(mode="stream", status=status)
+
+def synthesize(text: str, format="wav") -> bytes | None:
+    return pool.submit(text, format).result()